@@ -0,0 +1,113 @@
+import os
+import json
+import uuid
+import hashlib
+import numpy as np
+import rasterio
+from affine import Affine
+
+
+# Кэш декодированных каналов включается заданием папки (или переменной окружения BAND_CACHE_DIR)
+CACHE_DIR = os.environ.get("BAND_CACHE_DIR") or None
+BUDGET_BYTES = int(float(os.environ.get("BAND_CACHE_BUDGET_GB", "20")) * 1024 ** 3)
+
+
+def configure(cache_dir, budget_gb=None):
+    """
+    Включает (cache_dir) или отключает (None) кэш и задаёт лимит его размера на диске.
+    """
+    global CACHE_DIR, BUDGET_BYTES
+    CACHE_DIR = cache_dir
+    if budget_gb is not None:
+        BUDGET_BYTES = int(budget_gb * 1024 ** 3)
+
+
+def _read_tiff(file_path):
+    with rasterio.open(file_path) as src:
+        return src.read(), src.transform
+
+
+def _entry_paths(file_path):
+    key = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:20]
+    return os.path.join(CACHE_DIR, f"{key}.npy"), os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def _evict(keep):
+    """
+    Удаляет давно не использованные записи (LRU по mtime), пока кэш не уложится в BUDGET_BYTES.
+    """
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        # Недописанные .tmp.npy принадлежат другим процессам, их не трогаем
+        if name.endswith(".npy") and not name.endswith(".tmp.npy"):
+            path = os.path.join(CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # Уже удалён другим процессом
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= BUDGET_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:  # Windows: .npy открыт через mmap другим процессом - запись занята
+            continue
+        try:
+            os.remove(path[:-len(".npy")] + ".json")
+        except OSError:
+            pass
+        total -= size
+
+
+def read_bands(file_path):
+    """
+    Читает все каналы .tiff файла. При включённом кэше каналы берутся из .npy файла,
+    открытого через np.load(mmap_mode='r') - без повторного декодирования GeoTIFF; запись
+    кэша сбрасывается при изменении размера или mtime исходного файла.
+    :return: (массив [каналы, высота, ширина], transform)
+    """
+    if CACHE_DIR is None:
+        return _read_tiff(file_path)
+
+    stat = os.stat(file_path)
+    npy_path, meta_path = _entry_paths(file_path)
+    if os.path.exists(npy_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            if meta["size"] == stat.st_size and meta["mtime_ns"] == stat.st_mtime_ns:
+                os.utime(npy_path)  # Отметка использования для LRU
+                return np.load(npy_path, mmap_mode="r"), Affine(*meta["transform"])
+        except FileNotFoundError:
+            pass  # Запись вытеснена другим процессом - декодируем заново
+
+    bands, transform = _read_tiff(file_path)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Временные имена уникальны: ту же запись может одновременно писать другой процесс
+    suffix = uuid.uuid4().hex
+    tmp_path = f"{npy_path}.{suffix}.tmp.npy"
+    tmp_meta = f"{meta_path}.{suffix}.tmp"
+    try:
+        np.save(tmp_path, bands)
+        os.replace(tmp_path, npy_path)
+        with open(tmp_meta, "w") as f:
+            json.dump({"source": os.path.abspath(file_path), "size": stat.st_size,
+                       "mtime_ns": stat.st_mtime_ns, "transform": list(transform)[:6]}, f)
+        os.replace(tmp_meta, meta_path)
+    except OSError as e:
+        # Windows: старая запись открыта через mmap и не заменяется - отдаём каналы без кэша
+        print(f"Band cache entry for {file_path} is busy, not cached: {e}")
+        for path in (tmp_path, tmp_meta):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return bands, transform
+    _evict(keep=npy_path)
+    return bands, transform
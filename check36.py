@@ -1,31 +1,46 @@
 import os
 
-main_path = r"D:\omela\new_band_data"
 
-# Получаем список всех папок в основной директории
-folders = [f for f in os.listdir(main_path) if os.path.isdir(os.path.join(main_path, f))]
-
-# Сортируем папки по имени для единообразия
-folders_sorted = sorted(folders)
-
-# Проверяем общее количество папок
-if len(folders_sorted) != 70:
-    print(f"Внимание! Найдено {len(folders_sorted)} папок вместо 70")
-
-# Проверяем каждую папку
-for idx, folder in enumerate(folders_sorted, start=1):
-    folder_path = os.path.join(main_path, folder)
-
-    try:
-        # Получаем список подпапок
-        subfolders = [f for f in os.listdir(folder_path)
-                      if os.path.isdir(os.path.join(folder_path, f))]
-
-        # Проверяем количество
-        if len(subfolders) < 36:
-            print(f"Папка #{idx}: '{folder}' содержит только {len(subfolders)} подпапок")
-
-    except PermissionError:
-        print(f"Папка #{idx}: '{folder}' - нет доступа")
-    except Exception as e:
-        print(f"Папка #{idx}: '{folder}' - ошибка: {str(e)}")
+def audit(main_path, expected_granules=70, expected_tiles=36):
+    """
+    Проверяет, что в main_path ожидаемое число папок гранул и в каждой не меньше expected_tiles подпапок тайлов.
+    :return: Число проблемных папок.
+    """
+    # Получаем список всех папок в основной директории
+    folders = [f for f in os.listdir(main_path) if os.path.isdir(os.path.join(main_path, f))]
+
+    # Сортируем папки по имени для единообразия
+    folders_sorted = sorted(folders)
+
+    # Проверяем общее количество папок
+    if len(folders_sorted) != expected_granules:
+        print(f"Внимание! Найдено {len(folders_sorted)} папок вместо {expected_granules}")
+
+    problems = 0
+    # Проверяем каждую папку
+    for idx, folder in enumerate(folders_sorted, start=1):
+        folder_path = os.path.join(main_path, folder)
+
+        try:
+            # Получаем список подпапок
+            subfolders = [f for f in os.listdir(folder_path)
+                          if os.path.isdir(os.path.join(folder_path, f))]
+
+            # Проверяем количество
+            if len(subfolders) < expected_tiles:
+                print(f"Папка #{idx}: '{folder}' содержит только {len(subfolders)} подпапок")
+                problems += 1
+
+        except PermissionError:
+            print(f"Папка #{idx}: '{folder}' - нет доступа")
+            problems += 1
+        except Exception as e:
+            print(f"Папка #{idx}: '{folder}' - ошибка: {str(e)}")
+            problems += 1
+    return problems
+
+
+if __name__ == "__main__":
+    main_path = r"D:\omela\new_band_data"
+
+    audit(main_path)
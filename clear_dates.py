@@ -0,0 +1,610 @@
+import os
+import json
+import math
+import uuid
+import rasterio
+import numpy as np
+from datetime import datetime, timedelta
+from sentinelhub import (
+    SentinelHubRequest, SentinelHubStatistical, BBox, CRS, MimeType, DataCollection,
+    MosaickingOrder, bbox_to_dimensions
+)
+import sh_session
+
+
+def download_clm_mask(bbox, time_interval, config, target_size):
+    evalscript_clm = """
+    function setup() {
+        return {
+            input: ["CLM"],
+            output: {
+                bands: 1,
+                sampleType: "FLOAT32"
+            }
+        };
+    }
+
+    function evaluatePixel(sample) {
+        return [sample.CLM ? 1.0 : 0.0];
+    }
+    """
+    request = SentinelHubRequest(
+        evalscript=evalscript_clm,
+        input_data=[SentinelHubRequest.input_data(
+            data_collection=DataCollection.SENTINEL2_L1C,
+            time_interval=time_interval
+        )],
+        responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
+        bbox=bbox,
+        size=target_size,
+        config=config
+    )
+    response = sh_session.get_data(request)
+    return np.array(response[0])  # Преобразование ответа в NumPy массив
+
+
+def download_clm_profile(bbox, time_interval, config, target_size, scale=6):
+    """
+    Одним запросом к Statistical API получает облачный профиль тайла за весь сезон.
+    :param bbox: BBox тайла.
+    :param time_interval: Весь интервал поиска (начало, конец).
+    :param target_size: Размер тайла в пикселях [width, height].
+    :param scale: Во сколько раз огрубить сетку статистики (CLM и так имеет разрешение 160 м).
+    :return: Словарь {дата: {'clm_mean': доля облачных пикселей, 'valid_count': число валидных пикселей}}.
+    """
+    evalscript_clm_stats = """
+    //VERSION=3
+    function setup() {
+        return {
+            input: [{bands: ["CLM", "dataMask"]}],
+            output: [
+                {id: "clm", bands: 1, sampleType: "FLOAT32"},
+                {id: "dataMask", bands: 1}
+            ]
+        };
+    }
+
+    function evaluatePixel(sample) {
+        return {clm: [sample.CLM], dataMask: [sample.dataMask]};
+    }
+    """
+    profile_size = (max(1, target_size[0] // scale), max(1, target_size[1] // scale))
+    request = SentinelHubStatistical(
+        aggregation=SentinelHubStatistical.aggregation(
+            evalscript=evalscript_clm_stats,
+            time_interval=time_interval,
+            aggregation_interval="P1D",
+            size=profile_size
+        ),
+        input_data=[SentinelHubStatistical.input_data(DataCollection.SENTINEL2_L1C)],
+        bbox=bbox,
+        config=config
+    )
+    response = sh_session.get_data(request)[0]
+
+    profile = {}
+    for item in response.get("data", []):
+        stats = item.get("outputs", {}).get("clm", {}).get("bands", {}).get("B0", {}).get("stats")
+        if not stats:
+            continue
+        valid_count = stats.get("sampleCount", 0) - stats.get("noDataCount", 0)
+        if valid_count <= 0:
+            continue  # Снимка за этот день нет
+        date = datetime.strptime(item["interval"]["from"][:10], "%Y-%m-%d")
+        profile[date] = {"clm_mean": float(stats["mean"]), "valid_count": valid_count}
+    return profile
+
+
+def rank_candidate_dates(profile, max_candidates=5):
+    """
+    Ранжирует даты по облачному профилю: сначала наименее облачные, при равенстве -
+    с наибольшим числом валидных пикселей, затем более ранние.
+    :param profile: Результат download_clm_profile.
+    :param max_candidates: Сколько лучших дат вернуть для проверки через compare_masks.
+    :return: Список дат.
+    """
+    ranked = sorted(profile, key=lambda d: (profile[d]["clm_mean"], -profile[d]["valid_count"], d))
+    return ranked[:max_candidates]
+
+
+def load_tile_bbox(tile_dir):
+    """
+    Возвращает BBox тайла из meta.json (его пишет get_gridded_data.py), иначе - из границ response.tiff.
+    """
+    meta_path = os.path.join(tile_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        coords = [pt for ring in meta['bbox']['coordinates'] for pt in ring]
+        xs = [pt[0] for pt in coords]
+        ys = [pt[1] for pt in coords]
+        return BBox(bbox=[min(xs), min(ys), max(xs), max(ys)], crs=CRS.WGS84)
+    with rasterio.open(os.path.join(tile_dir, 'response.tiff')) as src:
+        return BBox(bbox=list(src.bounds), crs=CRS.WGS84)
+
+
+def download_granule_clm(bbox, time_interval, config, size):
+    """
+    Грубая CLM-маска на всю гранулу. В отличие от download_clm_mask, пиксели без данных
+    возвращаются как NaN, чтобы compare_masks их не учитывал.
+    """
+    evalscript_clm = """
+    function setup() {
+        return {
+            input: ["CLM", "dataMask"],
+            output: {
+                bands: 1,
+                sampleType: "FLOAT32"
+            }
+        };
+    }
+
+    function evaluatePixel(sample) {
+        if (sample.dataMask == 0) {
+            return [NaN];
+        }
+        return [sample.CLM ? 1.0 : 0.0];
+    }
+    """
+    request = SentinelHubRequest(
+        evalscript=evalscript_clm,
+        input_data=[SentinelHubRequest.input_data(
+            data_collection=DataCollection.SENTINEL2_L1C,
+            time_interval=time_interval
+        )],
+        responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
+        bbox=bbox,
+        size=size,
+        config=config
+    )
+    response = sh_session.get_data(request)
+    return np.array(response[0])
+
+
+def slice_tile_window(granule_mask, granule_bbox, tile_bbox):
+    """
+    Вырезает из грубой маски гранулы окно, соответствующее bbox тайла.
+    """
+    height, width = granule_mask.shape[:2]
+    span_x = granule_bbox.max_x - granule_bbox.min_x
+    span_y = granule_bbox.max_y - granule_bbox.min_y
+    col0 = int(math.floor((tile_bbox.min_x - granule_bbox.min_x) / span_x * width))
+    col1 = int(math.ceil((tile_bbox.max_x - granule_bbox.min_x) / span_x * width))
+    row0 = int(math.floor((granule_bbox.max_y - tile_bbox.max_y) / span_y * height))
+    row1 = int(math.ceil((granule_bbox.max_y - tile_bbox.min_y) / span_y * height))
+    col0, row0 = max(col0, 0), max(row0, 0)
+    col1, row1 = min(max(col1, col0 + 1), width), min(max(row1, row0 + 1), height)
+    return granule_mask[row0:row1, col0:col1]
+
+
+def resample_nearest(mask, shape):
+    """
+    Приводит маску к размеру shape (ближайший сосед), чтобы сравнить её с грубым окном.
+    """
+    rows = ((np.arange(shape[0]) + 0.5) * mask.shape[0] / shape[0]).astype(int)
+    cols = ((np.arange(shape[1]) + 0.5) * mask.shape[1] / shape[1]).astype(int)
+    return mask[np.ix_(rows, cols)]
+
+
+def find_dates_hierarchical(tiles, candidate_dates, config, granule_resolution=160,
+                            coarse_threshold=0.95, threshold=1.0, date_memo=None):
+    """
+    Иерархический поиск ясных дат: одна грубая CLM-маска на всю гранулу за дату,
+    из неё окна для каждого тайла, и только прошедшие тайлы проверяются полноразмерной маской.
+    :param tiles: Словарь {имя тайла: {'bbox': BBox, 'size': [w, h], 'clm': старая CLM-маска}}.
+    :param candidate_dates: Даты в порядке перебора.
+    :param granule_resolution: Разрешение грубой маски гранулы в метрах (CLM - 160 м).
+    :param coarse_threshold: Порог compare_masks для грубого окна (на границах облаков он неточен).
+    :param threshold: Порог compare_masks для полноразмерной проверки.
+    :param date_memo: Общий для гранулы словарь {дата: грубая маска или None}, переиспользуется тайлами.
+    :return: Словарь {имя тайла: (дата, time_interval)} для найденных тайлов.
+    """
+    if date_memo is None:
+        date_memo = {}
+    bboxes = [tile['bbox'] for tile in tiles.values()]
+    granule_bbox = BBox(bbox=[min(b.min_x for b in bboxes), min(b.min_y for b in bboxes),
+                              max(b.max_x for b in bboxes), max(b.max_y for b in bboxes)], crs=CRS.WGS84)
+    granule_size = bbox_to_dimensions(granule_bbox, resolution=granule_resolution)
+
+    found = {}
+    for current_date in candidate_dates:
+        pending = [name for name in tiles if name not in found]
+        if not pending:
+            break
+        time_interval = (current_date.strftime('%Y-%m-%dT00:00:00Z'),
+                         current_date.strftime('%Y-%m-%dT23:59:59Z'))
+        if current_date not in date_memo:
+            try:
+                granule_mask = download_granule_clm(granule_bbox, time_interval, config, granule_size)
+                date_memo[current_date] = None if np.all(np.isnan(granule_mask)) else granule_mask
+            except Exception as e:
+                print(f"Error downloading granule mask for {current_date.date()}: {e}")
+                continue
+        granule_mask = date_memo[current_date]
+        if granule_mask is None:
+            continue  # Пролёта в этот день не было
+
+        for name in pending:
+            tile = tiles[name]
+            window = slice_tile_window(granule_mask, granule_bbox, tile['bbox'])
+            if not compare_masks(resample_nearest(tile['clm'], window.shape), window, threshold=coarse_threshold):
+                continue
+            try:
+                new_mask = download_clm_mask(tile['bbox'], time_interval, config, tile['size'])
+                if compare_masks(tile['clm'], new_mask, threshold=threshold):
+                    print(f"Masks matched for {current_date.date()} in {name}")
+                    found[name] = (current_date, time_interval)
+            except Exception as e:
+                print(f"Error verifying mask for {current_date.date()} in {name}: {e}")
+    return found
+
+
+def save_tiff_response(request, bbox, target_size, output_dir, passthrough=True):
+    """
+    Выполняет запрос Process API и сохраняет ответ в output_dir/bands.tiff (через временный файл).
+    :param passthrough: Сохранить TIFF из ответа API без перекодирования (геопривязка дописывается,
+        только если её нет в ответе). При False ответ декодируется и пишется заново через rasterio.
+    :return: Путь к bands.tiff.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"Save path: {output_dir}")
+
+    output_file = os.path.join(output_dir, "bands.tiff")
+    # Прерванная загрузка не должна оставить обрезанный bands.tiff, а два воркера одного задания -
+    # писать в один временный файл
+    tmp_file = f"{output_file}.{uuid.uuid4().hex}.tmp"
+    transform = rasterio.transform.from_bounds(*bbox, width=target_size[0], height=target_size[1])
+
+    try:
+        if passthrough:
+            # TIFF из ответа API записывается как есть, без декодирования в numpy и повторного кодирования
+            response = sh_session.get_data(request, decode_data=False)
+            if not response or not response[0].content:
+                raise ValueError("Empty response received from SentinelHub")
+            with open(tmp_file, "wb") as dst:
+                dst.write(response[0].content)
+            with rasterio.open(tmp_file, "r+") as dst:
+                if dst.crs is None or dst.transform.is_identity:
+                    dst.crs = bbox.crs.pyproj_crs()
+                    dst.transform = transform
+        else:
+            response = sh_session.get_data(request)
+            if not response:
+                raise ValueError("Empty response received from SentinelHub")
+            with rasterio.open(
+                    tmp_file,
+                    "w",
+                    driver="GTiff",
+                    height=target_size[1],
+                    width=target_size[0],
+                    count=np.atleast_3d(response[0]).shape[2],
+                    dtype=response[0].dtype.name,
+                    crs=bbox.crs.pyproj_crs(),
+                    transform=transform
+            ) as dst:
+                dst.write(np.moveaxis(np.atleast_3d(response[0]), 2, 0))
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, output_file)
+
+    print(f"New bands saved to: {output_file}")
+    return output_file
+
+
+def download_new_bands(bbox, time_interval, config, target_size, output_dir, passthrough=True):
+    """
+    Скачивает B04 и B08 на заданный интервал в output_dir/bands.tiff.
+    :param passthrough: См. save_tiff_response.
+    """
+    evalscript_bands = """
+    function setup() {
+        return {
+            input: ["B04", "B08"],
+            output: {
+                bands: 2,
+                sampleType: "FLOAT32"
+            }
+        };
+    }
+
+    function evaluatePixel(sample) {
+        return [sample.B04, sample.B08];
+    }
+    """
+    request = SentinelHubRequest(
+        evalscript=evalscript_bands,
+        input_data=[SentinelHubRequest.input_data(
+            data_collection=DataCollection.SENTINEL2_L1C,
+            time_interval=time_interval
+        )],
+        responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
+        bbox=bbox,
+        size=target_size,
+        config=config
+    )
+
+    save_tiff_response(request, bbox, target_size, output_dir, passthrough)
+
+
+def download_composite_bands(bbox, time_interval, config, target_size, output_dir, passthrough=True):
+    """
+    Одним запросом за весь сезон собирает безоблачную композицию B04/B08: снимки перебираются
+    от наименее облачного (MosaickingOrder.LEAST_CC), и для каждого пикселя берётся первое
+    наблюдение без облака по CLM. Если чистых наблюдений нет, берётся наименее облачное.
+    Сохраняется в output_dir/bands.tiff с каналами B04, B08, дата наблюдения (дни от 1970-01-01), CLM.
+    :param time_interval: Весь интервал поиска (начало, конец).
+    """
+    evalscript_composite = """
+    //VERSION=3
+    function setup() {
+        return {
+            input: [{bands: ["B04", "B08", "CLM", "dataMask"]}],
+            output: {
+                bands: 4,
+                sampleType: "FLOAT32"
+            },
+            mosaicking: "ORBIT"
+        };
+    }
+
+    function evaluatePixel(samples, scenes) {
+        var chosen = -1;
+        for (var i = 0; i < samples.length; i++) {
+            if (!samples[i].dataMask) continue;
+            if (chosen < 0) chosen = i;  // Наименее облачный снимок - запасной вариант
+            if (samples[i].CLM == 0) {
+                chosen = i;
+                break;
+            }
+        }
+        if (chosen < 0) {
+            return [NaN, NaN, NaN, NaN];
+        }
+        var sample = samples[chosen];
+        var day = Math.floor(Date.parse(scenes.orbits[chosen].dateFrom) / 86400000);
+        return [sample.B04, sample.B08, day, sample.CLM];
+    }
+    """
+    request = SentinelHubRequest(
+        evalscript=evalscript_composite,
+        input_data=[SentinelHubRequest.input_data(
+            data_collection=DataCollection.SENTINEL2_L1C,
+            time_interval=time_interval,
+            mosaicking_order=MosaickingOrder.LEAST_CC
+        )],
+        responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
+        bbox=bbox,
+        size=target_size,
+        config=config
+    )
+
+    return save_tiff_response(request, bbox, target_size, output_dir, passthrough)
+
+
+def compare_masks(original_mask, candidate_mask, threshold=1.0):
+    if original_mask.shape != candidate_mask.shape:
+        raise ValueError(f"Размерности масок не совпадают: {original_mask.shape} и {candidate_mask.shape}")
+    valid_mask = (~np.isnan(original_mask)) & (~np.isnan(candidate_mask))
+    if np.sum(valid_mask) == 0:
+        return False
+    no_clouds_original = (original_mask[valid_mask] == 0)
+    no_clouds_match = (candidate_mask[valid_mask][no_clouds_original] == 0)
+    match_ratio = np.sum(no_clouds_match) / np.sum(no_clouds_original)
+    return match_ratio >= threshold
+
+
+def make_config(ins_id):
+    return sh_session.make_config('6ad7a64d-3006-4a1d-9a3e-caeccbce3c04', 'mvOFmvLWFgCOERsxRo4GP1PnKnkH8EU6', ins_id)
+
+
+DATES_FILENAME = "dates.json"
+# Под этим ключом dates.json хранит параметры поиска, которыми он получен
+SEARCH_KEY = "_search"
+# Рядом с bands.tiff: запись dates.json (дата или окно композиции), на которую он скачан
+BANDS_SOURCE_FILENAME = "bands_source.json"
+
+
+def search_params(start_date, end_date, search_mode, max_candidates, threshold):
+    """
+    Параметры поиска дат для dates.json (даты - строки 'YYYY-MM-DD').
+    """
+    return {"start_date": start_date, "end_date": end_date, "mode": search_mode,
+            "max_candidates": max_candidates, "threshold": threshold}
+
+
+def read_dates(dates_file):
+    """
+    :return: (словарь {тайл: запись}, параметры поиска или None для файлов без них)
+    """
+    with open(dates_file, "r") as f:
+        found = json.load(f)
+    return found, found.pop(SEARCH_KEY, None)
+
+
+def write_dates(dates_file, found, search=None):
+    """
+    Атомарно записывает dates.json вместе с параметрами поиска.
+    """
+    data = dict(found)
+    if search is not None:
+        data[SEARCH_KEY] = search
+    tmp_file = f"{dates_file}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_file, dates_file)
+
+
+def day_interval(date):
+    """
+    Интервал запроса на одни сутки.
+    """
+    return (date.strftime('%Y-%m-%dT00:00:00Z'), date.strftime('%Y-%m-%dT23:59:59Z'))
+
+
+def load_granule_tiles(input_path):
+    """
+    Читает для каждого тайла гранулы bbox, размер и CLM-маску (4-й канал response.tiff).
+    :return: Словарь {имя тайла: {'bbox': BBox, 'size': [w, h], 'clm': маска}}.
+    """
+    tiles = {}
+    for name_folder in sorted(os.listdir(input_path)):
+        response_file = os.path.join(input_path, name_folder, 'response.tiff')
+        if not os.path.exists(response_file):
+            print(f"Response file not found in {os.path.join(input_path, name_folder)}, skipping.")
+            continue
+        try:
+            with rasterio.open(response_file) as src:
+                tiles[name_folder] = {'bbox': load_tile_bbox(os.path.join(input_path, name_folder)),
+                                      'size': [src.width, src.height],
+                                      'clm': src.read(4)}
+        except Exception as e:
+            print(f"Error processing file {response_file}: {e}")
+    return tiles
+
+
+def find_tile_date(tile, candidate_dates, config, threshold=1.0):
+    """
+    Перебирает даты-кандидаты для одного тайла, пока CLM-маска не совпадёт со старой.
+    :return: (дата, time_interval) или None.
+    """
+    for current_date in candidate_dates:
+        time_interval = day_interval(current_date)
+        try:
+            new_mask = download_clm_mask(tile['bbox'], time_interval, config, tile['size'])
+            if compare_masks(tile['clm'], new_mask, threshold=threshold):
+                print(f"Masks matched for {current_date.date()}")
+                return current_date, time_interval
+            print(f"Masks do not match for {current_date.date()}.")
+        except Exception as e:
+            print(f"Error downloading or processing mask for {current_date.date()}: {e}")
+    return None
+
+
+def find_granule_dates(input_path, config, start_date, end_date, search_mode="hierarchical",
+                       max_candidates=5, threshold=1.0):
+    """
+    Ищет для каждого тайла гранулы дату, облачная маска которой совпадает со старой.
+    :param input_path: Папка гранулы с подпапками тайлов (response.tiff, meta.json).
+    :param search_mode: "hierarchical" - одна грубая маска гранулы на дату, "profile" - Statistical API
+        на тайл, "daily" - перебор по дням для каждого тайла, "composite" - без поиска: каждый тайл
+        потом скачивается одной безоблачной композицией за весь интервал (download_composite_bands).
+    :return: Словарь {имя тайла: {'date': 'YYYY-MM-DD', 'bbox': [...], 'size': [w, h]}}. В режиме
+        composite вместо даты - None и 'composite': [начало, конец].
+    """
+    tiles = load_granule_tiles(input_path)
+    if search_mode == "composite":
+        return {name: {'date': None,
+                       'composite': [start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')],
+                       'bbox': list(tile['bbox']),
+                       'size': tile['size']}
+                for name, tile in tiles.items()}
+    all_dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+
+    if search_mode == "hierarchical":
+        matches = find_dates_hierarchical(tiles, all_dates, config, threshold=threshold) if tiles else {}
+    else:
+        matches = {}
+        for name_folder, tile in tiles.items():
+            print(f"Searching date for {name_folder}")
+            if search_mode == "profile":
+                season_interval = (start_date.strftime('%Y-%m-%dT00:00:00Z'),
+                                   end_date.strftime('%Y-%m-%dT23:59:59Z'))
+                try:
+                    profile = download_clm_profile(tile['bbox'], season_interval, config, tile['size'])
+                except Exception as e:
+                    print(f"Error downloading cloud profile for {name_folder}: {e}")
+                    continue
+                candidate_dates = rank_candidate_dates(profile, max_candidates)
+                print(f"Candidate dates for {name_folder}: {[d.date() for d in candidate_dates]}")
+            else:
+                candidate_dates = all_dates
+            match = find_tile_date(tile, candidate_dates, config, threshold=threshold)
+            if match:
+                matches[name_folder] = match
+
+    for name_folder in sorted(set(tiles) - set(matches)):
+        print(f"No matching date found for {name_folder} in {input_path}")
+    return {name: {'date': date.strftime('%Y-%m-%d'),
+                   'bbox': list(tiles[name]['bbox']),
+                   'size': tiles[name]['size']}
+            for name, (date, _) in matches.items()}
+
+
+def download_granule_bands(found, output_dir, config):
+    """
+    Скачивает B04/B08 на найденные даты в output_dir/<тайл>/bands.tiff.
+    :param found: Результат find_granule_dates (или прочитанный dates.json).
+    """
+    for name_folder, entry in found.items():
+        bbox = BBox(bbox=entry['bbox'], crs=CRS.WGS84)
+        try:
+            if entry.get('composite'):
+                start, end = entry['composite']
+                season_interval = (f"{start}T00:00:00Z", f"{end}T23:59:59Z")
+                download_composite_bands(bbox, season_interval, config, entry['size'],
+                                         os.path.join(output_dir, name_folder))
+            else:
+                time_interval = day_interval(datetime.strptime(entry['date'], '%Y-%m-%d'))
+                download_new_bands(bbox, time_interval, config, entry['size'], os.path.join(output_dir, name_folder))
+            write_bands_source(os.path.join(output_dir, name_folder), entry)
+        except Exception as e:
+            print(f"Error downloading bands for {entry['date'] or 'composite'} in {name_folder}: {e}")
+
+
+def bands_source(entry):
+    """
+    Дата или окно композиции, на которые скачан bands.tiff по записи dates.json.
+    """
+    return {"date": entry.get("date"), "composite": entry.get("composite")}
+
+
+def read_bands_source(tile_dir):
+    source_file = os.path.join(tile_dir, BANDS_SOURCE_FILENAME)
+    if not os.path.exists(source_file):
+        return None
+    with open(source_file, "r") as f:
+        return json.load(f)
+
+
+def write_bands_source(tile_dir, entry):
+    with open(os.path.join(tile_dir, BANDS_SOURCE_FILENAME), "w") as f:
+        json.dump(bands_source(entry), f)
+
+
+def invalidate_bands(found, output_dir):
+    """
+    Вызывается, когда dates.json пересчитан с другими параметрами поиска: удаляет bands.tiff тайлов,
+    которых нет в новом found или которые скачаны на другую дату/окно (или без bands_source.json).
+    """
+    for name_folder in sorted(os.listdir(output_dir)):
+        tile_dir = os.path.join(output_dir, name_folder)
+        bands_path = os.path.join(tile_dir, "bands.tiff")
+        if not os.path.exists(bands_path):
+            continue
+        entry = found.get(name_folder)
+        if entry is None or read_bands_source(tile_dir) != bands_source(entry):
+            print(f"Bands in {name_folder} do not match the new dates.json, removing")
+            os.remove(bands_path)
+            source_file = os.path.join(tile_dir, BANDS_SOURCE_FILENAME)
+            if os.path.exists(source_file):
+                os.remove(source_file)
+
+
+def bands_to_download(found, output_dir):
+    """
+    Записи dates.json, для которых bands.tiff ещё нет или он скачан на другую дату/окно.
+    bands.tiff без bands_source.json (скачанные до его появления) считаются актуальными - при смене
+    параметров поиска их убирает invalidate_bands.
+    """
+    pending = {}
+    for name_folder, entry in found.items():
+        tile_dir = os.path.join(output_dir, name_folder)
+        if not os.path.exists(os.path.join(tile_dir, "bands.tiff")):
+            pending[name_folder] = entry
+            continue
+        source = read_bands_source(tile_dir)
+        if source is not None and source != bands_source(entry):
+            pending[name_folder] = entry
+    return pending
@@ -0,0 +1,377 @@
+"""
+Единая точка входа для всех этапов обработки:
+
+    python cli.py ingest --src D:\\omela\\scoltech_150k\\src --out D:\\omela\\output_data_sentinel
+    python cli.py find-dates --input D:\\omela\\output_data_sentinel --output D:\\omela\\new_band_data
+    python cli.py download-bands --dir D:\\omela\\new_band_data
+    python cli.py index --bands-dir D:\\omela\\new_band_data --comparison-dir D:\\omela\\output_data_sentinel
+    python cli.py vectorize --bands-dir D:\\omela\\new_band_data --comparison-dir D:\\omela\\output_data_sentinel
+    python cli.py audit --path D:\\omela\\new_band_data
+
+Оценка прогона до запуска (запросы, PU, объём, время):
+
+    python cli.py plan --src D:\\omela\\scoltech_150k\\src --history-dir D:\\omela\\new_band_data --concurrency 20
+
+Распределённый режим: задания ставятся в общую очередь (файл SQLite на общем диске),
+а воркеры на любых машинах забирают их в аренду:
+
+    python cli.py enqueue-dates --db Z:\\queue.sqlite --input ... --output ...
+    python cli.py enqueue-masks --db Z:\\queue.sqlite --bands-dir ... --comparison-dir ...
+    python cli.py worker --db Z:\\queue.sqlite
+
+Непрерывный режим: новые гранулы в папке src проходят все этапы по мере поступления:
+
+    python cli.py watch --src D:\\omela\\scoltech_150k\\src --out D:\\omela\\output_data_sentinel --bands-dir D:\\omela\\new_band_data
+
+Тяжёлые зависимости (sentinelhub, rasterio, shapely) импортируются только внутри подкоманд,
+поэтому дешёвые команды вроде audit запускаются мгновенно.
+"""
+import argparse
+import json
+import os
+import sys
+
+
+DEFAULT_INSTANCE_ID = "6cec2602-3a03-4980-b48a-4d17f8f59bbe"
+
+
+def cmd_ingest(args):
+    from get_gridded_data import ingest_granules
+
+    ingest_granules(args.src, args.out, args.start, args.stop, not args.no_triage, args.max_cloud,
+                    args.triage_report)
+    return 0
+
+
+def cmd_find_dates(args):
+    from datetime import datetime
+    from clear_dates import DATES_FILENAME, make_config, search_params, write_dates, find_granule_dates
+
+    config = make_config(args.instance_id)
+    search = search_params(args.start_date, args.end_date, args.mode, args.max_candidates, args.threshold)
+    start_date = datetime.strptime(args.start_date, "%Y-%m-%d")
+    end_date = datetime.strptime(args.end_date, "%Y-%m-%d")
+
+    for folder in sorted(os.listdir(args.input)):
+        input_path = os.path.join(args.input, folder)
+        if not os.path.isdir(input_path) or (args.granule and folder not in args.granule):
+            continue
+        found = find_granule_dates(input_path, config, start_date, end_date, args.mode,
+                                   args.max_candidates, args.threshold)
+        output_dir = os.path.join(args.output, folder)
+        os.makedirs(output_dir, exist_ok=True)
+        write_dates(os.path.join(output_dir, DATES_FILENAME), found, search)
+        print(f"{len(found)} dates saved for {folder}")
+    return 0
+
+
+def cmd_download_bands(args):
+    from clear_dates import DATES_FILENAME, make_config, read_dates, download_granule_bands
+
+    config = make_config(args.instance_id)
+    for folder in sorted(os.listdir(args.dir)):
+        dates_file = os.path.join(args.dir, folder, DATES_FILENAME)
+        if not os.path.exists(dates_file) or (args.granule and folder not in args.granule):
+            continue
+        found, _ = read_dates(dates_file)
+        download_granule_bands(found, os.path.join(args.dir, folder), config)
+    return 0
+
+
+def cmd_index(args):
+    from mask_stage import index_granules
+
+    index_granules(args.bands_dir, args.comparison_dir)
+    return 0
+
+
+def cmd_vectorize(args):
+    from mask_stage import vectorize_granules
+
+    vectorize_options = {"min_pixels": args.min_pixels, "closing_iterations": args.closing,
+                         "simplify_m": args.simplify_m}
+    vectorize_granules(args.bands_dir, args.comparison_dir, args.ndwi_threshold, args.diff_threshold,
+                       vectorize_options, args.stats_db)
+    return 0
+
+
+def cmd_preview(args):
+    from previews import render_previews
+
+    count = render_previews(args.bands_dir, args.comparison_dir, args.factor, args.workers)
+    print(f"Превью тайлов: {count}")
+    return 0
+
+
+def cmd_audit(args):
+    from check36 import audit
+
+    problems = audit(args.path, args.expected_granules, args.expected_tiles)
+    return 1 if problems else 0
+
+
+def cmd_enqueue_dates(args):
+    from tile_queue import connect, enqueue_find_dates
+
+    conn = connect(args.db)
+    added = enqueue_find_dates(conn, args.input, args.output, args.start_date, args.end_date, args.mode,
+                               args.max_candidates, args.threshold, args.instance_id)
+    print(f"Добавлено заданий: {added}")
+    return 0
+
+
+def cmd_enqueue_masks(args):
+    from tile_queue import connect, enqueue_masks
+
+    conn = connect(args.db)
+    vectorize_options = {"min_pixels": args.min_pixels, "closing_iterations": args.closing,
+                         "simplify_m": args.simplify_m}
+    added = enqueue_masks(conn, args.bands_dir, args.comparison_dir, args.ndwi_threshold, args.diff_threshold,
+                          vectorize_options, args.stats_db)
+    print(f"Добавлено заданий: {added}")
+    return 0
+
+
+def cmd_worker(args):
+    from tile_queue import run_worker
+
+    done = run_worker(args.db, args.worker_id, args.lease_seconds, args.heartbeat_seconds,
+                      args.poll_seconds, exit_when_empty=not args.forever)
+    print(f"Выполнено заданий: {done}")
+    return 0
+
+
+def cmd_queue_status(args):
+    from tile_queue import connect, queue_status
+
+    for kind, status, count in queue_status(connect(args.db)):
+        print(f"{kind:12} {status:8} {count}")
+    return 0
+
+
+def cmd_watch(args):
+    from watch_daemon import make_stage_handlers, run_daemon
+
+    vectorize_options = {"min_pixels": args.min_pixels, "closing_iterations": args.closing,
+                         "simplify_m": args.simplify_m}
+    handlers = make_stage_handlers(args.out, args.bands_dir, args.instance_id, args.start_date, args.end_date,
+                                   args.mode, args.max_candidates, args.threshold, args.max_cloud,
+                                   args.ndwi_threshold, args.diff_threshold, vectorize_options, args.stats_db)
+    run_daemon(args.src, args.out, args.bands_dir, handlers, args.poll_seconds, args.queue_size,
+               args.settle_seconds)
+    return 0
+
+
+def cmd_serve(args):
+    from mask_service import serve
+
+    vectorize_options = {"min_pixels": args.min_pixels, "closing_iterations": args.closing,
+                         "simplify_m": args.simplify_m}
+    serve(args.comparison_dir, args.bands_dir, args.cache_dir, args.instance_id, args.host, args.port,
+          args.workers, vectorize_options)
+    return 0
+
+
+def cmd_plan(args):
+    from datetime import datetime
+    from get_gridded_data import list_granule_xmls
+    from planner import load_latencies, plan_run, print_plan
+
+    plan = plan_run(list_granule_xmls(args.src, args.start, args.stop),
+                    datetime.strptime(args.start_date, "%Y-%m-%d"), datetime.strptime(args.end_date, "%Y-%m-%d"),
+                    args.mode, args.max_candidates, args.expected_probes, args.history_dir,
+                    load_latencies(args.latency_file or os.environ.get("SH_LATENCY_FILE")),
+                    args.concurrency, not args.no_triage)
+    print_plan(plan)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(plan, f, indent=2)
+    return 0
+
+
+def cmd_compare_masks(args):
+    from rle_mask import load_rle, overlap
+
+    result = overlap(load_rle(args.a), load_rle(args.b))
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+def add_date_search_args(p):
+    p.add_argument("--start-date", default="2023-05-02")
+    p.add_argument("--end-date", default="2023-09-30")
+    p.add_argument("--mode", choices=["hierarchical", "profile", "daily", "composite"], default="hierarchical")
+    p.add_argument("--max-candidates", type=int, default=5, help="число дат-кандидатов в режиме profile")
+    p.add_argument("--threshold", type=float, default=1.0, help="порог compare_masks")
+    p.add_argument("--instance-id", default=DEFAULT_INSTANCE_ID)
+
+
+def add_mask_args(p):
+    p.add_argument("--ndwi-threshold", type=float, default=0.1)
+    p.add_argument("--diff-threshold", type=float, default=0.2)
+    p.add_argument("--min-pixels", type=int, default=0, help="порог sieve в пикселях")
+    p.add_argument("--closing", type=int, default=0, help="итерации морфологического закрытия")
+    p.add_argument("--simplify-m", type=float, default=0, help="допуск упрощения в метрах")
+    p.add_argument("--stats-db", default=None, help="файл SQLite для сводной статистики по тайлам")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Поиск изменений по снимкам Sentinel-2")
+    parser.add_argument("--band-cache", default=None,
+                        help="папка кэша декодированных каналов (.npy, читаются через mmap)")
+    parser.add_argument("--band-cache-gb", type=float, default=None, help="лимит размера кэша каналов, ГБ")
+    parser.add_argument("--accounts", default=None,
+                        help="JSON со списком учётных записей Sentinel Hub для распределения запросов")
+    parser.add_argument("--latency-log", default=None,
+                        help="JSON-журнал задержек запросов Sentinel Hub (история для plan)")
+    parser.add_argument("--polygonize-workers", type=int, default=None,
+                        help="число процессов для блочной векторизации больших масок")
+    parser.add_argument("--pool-size", type=int, default=None,
+                        help="число keep-alive соединений и потоков загрузки Sentinel Hub (по умолчанию 10)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("ingest", help="скачать гридированные данные по MTD_MSIL1C.xml гранул")
+    p.add_argument("--src", required=True, help="папка с распакованными .SAFE гранулами")
+    p.add_argument("--out", required=True, help="куда сохранять тайлы (response.tiff, meta.json)")
+    p.add_argument("--start", type=int, default=None, help="индекс первой гранулы")
+    p.add_argument("--stop", type=int, default=None, help="индекс, на котором остановиться")
+    p.add_argument("--max-cloud", type=float, default=None, help="отсеять гранулы с eo:cloud_cover выше, %%")
+    p.add_argument("--no-triage", action="store_true", help="не проверять гранулы по каталогу перед загрузкой")
+    p.add_argument("--triage-report", default=None, help="файл JSON с отчётом о проверке гранул")
+    p.set_defaults(func=cmd_ingest)
+
+    p = subparsers.add_parser("find-dates", help="найти даты с совпадающей облачностью для тайлов")
+    p.add_argument("--input", required=True, help="папка с тайлами гранул (output_data_sentinel)")
+    p.add_argument("--output", required=True, help="куда писать dates.json по гранулам (new_band_data)")
+    add_date_search_args(p)
+    p.add_argument("--granule", action="append", help="обработать только эти гранулы")
+    p.set_defaults(func=cmd_find_dates)
+
+    p = subparsers.add_parser("download-bands", help="скачать B04/B08 на даты из dates.json")
+    p.add_argument("--dir", required=True, help="папка с dates.json по гранулам (new_band_data)")
+    p.add_argument("--instance-id", default=DEFAULT_INSTANCE_ID)
+    p.add_argument("--granule", action="append", help="обработать только эти гранулы")
+    p.set_defaults(func=cmd_download_bands)
+
+    for name, func, help_text in [("index", cmd_index, "посчитать и закэшировать NDVI/NDWI"),
+                                  ("vectorize", cmd_vectorize, "построить mask.geojson по порогам")]:
+        p = subparsers.add_parser(name, help=help_text)
+        p.add_argument("--bands-dir", required=True, help="папка с bands.tiff (new_band_data)")
+        p.add_argument("--comparison-dir", required=True, help="папка с response.tiff (output_data_sentinel)")
+        p.set_defaults(func=func)
+        if name == "vectorize":
+            add_mask_args(p)
+
+    p = subparsers.add_parser("preview", help="построить preview.png тайлов и гранул для контроля")
+    p.add_argument("--bands-dir", required=True, help="папка с bands.tiff (new_band_data)")
+    p.add_argument("--comparison-dir", required=True, help="папка с response.tiff (output_data_sentinel)")
+    p.add_argument("--factor", type=int, default=8, help="во сколько раз уменьшать тайлы")
+    p.add_argument("--workers", type=int, default=None, help="число процессов")
+    p.set_defaults(func=cmd_preview)
+
+    p = subparsers.add_parser("audit", help="проверить комплектность папок гранул")
+    p.add_argument("--path", required=True)
+    p.add_argument("--expected-granules", type=int, default=70)
+    p.add_argument("--expected-tiles", type=int, default=36)
+    p.set_defaults(func=cmd_audit)
+
+    p = subparsers.add_parser("serve", help="локальный HTTP-сервис масок изменений по AOI")
+    p.add_argument("--comparison-dir", required=True, help="папка с response.tiff (output_data_sentinel)")
+    p.add_argument("--bands-dir", required=True, help="папка с bands.tiff и dates.json (new_band_data)")
+    p.add_argument("--cache-dir", required=True, help="кэш бэндов и масок сервиса")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--workers", type=int, default=4, help="сколько тайлов обрабатывать одновременно")
+    p.add_argument("--instance-id", default=DEFAULT_INSTANCE_ID)
+    p.add_argument("--min-pixels", type=int, default=0, help="порог sieve в пикселях")
+    p.add_argument("--closing", type=int, default=0, help="итерации морфологического закрытия")
+    p.add_argument("--simplify-m", type=float, default=0, help="допуск упрощения в метрах")
+    p.set_defaults(func=cmd_serve)
+
+    p = subparsers.add_parser("plan", help="оценить запросы, PU, объём и время прогона без загрузки")
+    p.add_argument("--src", required=True, help="папка с распакованными .SAFE гранулами")
+    p.add_argument("--start", type=int, default=None, help="индекс первой гранулы")
+    p.add_argument("--stop", type=int, default=None, help="индекс, на котором остановиться")
+    add_date_search_args(p)
+    p.add_argument("--expected-probes", type=float, default=None,
+                   help="ожидаемое число дней перебора на тайл (по умолчанию - по истории или всё окно)")
+    p.add_argument("--history-dir", default=None, help="dates.json прошлых прогонов (new_band_data)")
+    p.add_argument("--latency-file", default=None, help="журнал задержек запросов (по умолчанию SH_LATENCY_FILE)")
+    p.add_argument("--concurrency", type=int, default=10, help="одновременных запросов на все узлы")
+    p.add_argument("--no-triage", action="store_true", help="прогон без проверки гранул по каталогу")
+    p.add_argument("--output", default=None, help="сохранить оценку в JSON")
+    p.set_defaults(func=cmd_plan)
+
+    p = subparsers.add_parser("compare-masks", help="площади и перекрытие двух масок тайла (mask.rle.npz)")
+    p.add_argument("a")
+    p.add_argument("b")
+    p.set_defaults(func=cmd_compare_masks)
+
+    p = subparsers.add_parser("enqueue-dates", help="поставить в очередь поиск дат по гранулам")
+    p.add_argument("--db", required=True, help="файл общей очереди SQLite")
+    p.add_argument("--input", required=True, help="папка с тайлами гранул (output_data_sentinel)")
+    p.add_argument("--output", required=True, help="куда писать dates.json и bands.tiff (new_band_data)")
+    add_date_search_args(p)
+    p.set_defaults(func=cmd_enqueue_dates)
+
+    p = subparsers.add_parser("enqueue-masks", help="поставить в очередь построение масок по тайлам")
+    p.add_argument("--db", required=True, help="файл общей очереди SQLite")
+    p.add_argument("--bands-dir", required=True, help="папка с bands.tiff (new_band_data)")
+    p.add_argument("--comparison-dir", required=True, help="папка с response.tiff (output_data_sentinel)")
+    add_mask_args(p)
+    p.set_defaults(func=cmd_enqueue_masks)
+
+    p = subparsers.add_parser("worker", help="выполнять задания из общей очереди")
+    p.add_argument("--db", required=True, help="файл общей очереди SQLite")
+    p.add_argument("--worker-id", default=None, help="по умолчанию host:pid")
+    p.add_argument("--lease-seconds", type=float, default=300)
+    p.add_argument("--heartbeat-seconds", type=float, default=60)
+    p.add_argument("--poll-seconds", type=float, default=10)
+    p.add_argument("--forever", action="store_true", help="не завершаться, когда очередь пуста")
+    p.set_defaults(func=cmd_worker)
+
+    p = subparsers.add_parser("watch", help="следить за папкой гранул и обрабатывать новые гранулы")
+    p.add_argument("--src", required=True, help="папка, куда поступают .SAFE гранулы")
+    p.add_argument("--out", required=True, help="папка тайлов (output_data_sentinel)")
+    p.add_argument("--bands-dir", required=True, help="папка dates.json и bands.tiff (new_band_data)")
+    p.add_argument("--max-cloud", type=float, default=None, help="отсеять гранулы с eo:cloud_cover выше, %%")
+    p.add_argument("--poll-seconds", type=float, default=30, help="период опроса без inotify")
+    p.add_argument("--queue-size", type=int, default=2, help="ёмкость очереди перед каждым этапом")
+    p.add_argument("--settle-seconds", type=float, default=60, help="сколько xml не должен меняться")
+    add_date_search_args(p)
+    add_mask_args(p)
+    p.set_defaults(func=cmd_watch)
+
+    p = subparsers.add_parser("queue-status", help="состояние общей очереди")
+    p.add_argument("--db", required=True)
+    p.set_defaults(func=cmd_queue_status)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.band_cache:
+        import band_cache
+        band_cache.configure(args.band_cache, args.band_cache_gb)
+        # Воркеры и дочерние процессы подхватывают кэш через окружение
+        os.environ["BAND_CACHE_DIR"] = args.band_cache
+        if args.band_cache_gb is not None:
+            os.environ["BAND_CACHE_BUDGET_GB"] = str(args.band_cache_gb)
+    if args.accounts:
+        # sh_session загружает пул из окружения при импорте - так же его получают воркеры
+        os.environ["SH_ACCOUNTS_FILE"] = args.accounts
+    if args.latency_log:
+        os.environ["SH_LATENCY_FILE"] = args.latency_log
+    if args.polygonize_workers:
+        # Как и кэш каналов, передаётся воркерам через окружение; vectorize читает его при импорте
+        os.environ["POLYGONIZE_WORKERS"] = str(args.polygonize_workers)
+    if args.pool_size:
+        import sh_session
+        sh_session.configure_pool(args.pool_size)
+        os.environ["SH_POOL_SIZE"] = str(args.pool_size)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,58 +1,104 @@
 import math
-import requests 
-import datetime
 import os
-import xarray as xr
-import multiprocessing
-import matplotlib.pyplot as plt
-import tempfile
-from matplotlib import cm
-import numpy as np
-import pandas as pd
-import seaborn as sns
-from eolearn.core import SaveTask, LoadTask, FeatureType, EOWorkflow,linearly_connect_tasks, EOExecutor,OverwritePermission, EOPatch
-from eolearn.io import SentinelHubInputTask, SentinelHubDemTask, SentinelHubEvalscriptTask, get_available_timestamps
 from sentinelhub import (
     CRS,
     BBox,
-    WmsRequest,
-    HistogramType,
-    WcsRequest,
-    FisRequest,
-    Geometry,
-    CustomUrlParam,
     DataCollection,
-    DownloadRequest,
     MimeType,
-    MosaickingOrder,
-    SentinelHubDownloadClient,
     SentinelHubRequest,
     bbox_to_dimensions,
-    SentinelHubStatistical,
-    BBoxSplitter,
-    SentinelHubCatalog
+    BBoxSplitter
 
 )
 from pathlib import Path
 from datetime import datetime, timedelta
 import json
 from bs4 import BeautifulSoup
+import sh_session
 
-def download_gridded_data(heavy_dir_xml, path_out):
-    def parse_file(filename: str):
-        if filename.endswith('.xml'):
-            with open(filename, 'r') as file:
-                content = file.read()
-            soup = BeautifulSoup(content, 'xml')
-            gr_name = soup.find('Product_Info').find('PRODUCT_URI').text.split('.')[0]
-            date_start = soup.find('Product_Info').find('PRODUCT_START_TIME').text
-            coordinates_list = list(map(float, soup.find('n1:Geometric_Info').find('EXT_POS_LIST').text.split()))
-            coords = [(coordinates_list[i], coordinates_list[i + 1]) for i in range(0, len(coordinates_list), 2)]
-            left = min(coord[1] for coord in coords)   # Минимальная долгота
-            right = max(coord[1] for coord in coords)  # Максимальная долгота
-            bottom = min(coord[0] for coord in coords) # Минимальная широта
-            top = max(coord[0] for coord in coords)    # Максимальная широта
-        return gr_name, date_start, [left, bottom, right, top]
+
+def parse_file(filename: str):
+    if filename.endswith('.xml'):
+        with open(filename, 'r') as file:
+            content = file.read()
+        soup = BeautifulSoup(content, 'xml')
+        gr_name = soup.find('Product_Info').find('PRODUCT_URI').text.split('.')[0]
+        date_start = soup.find('Product_Info').find('PRODUCT_START_TIME').text
+        coordinates_list = list(map(float, soup.find('n1:Geometric_Info').find('EXT_POS_LIST').text.split()))
+        coords = [(coordinates_list[i], coordinates_list[i + 1]) for i in range(0, len(coordinates_list), 2)]
+        left = min(coord[1] for coord in coords)   # Минимальная долгота
+        right = max(coord[1] for coord in coords)  # Максимальная долгота
+        bottom = min(coord[0] for coord in coords) # Минимальная широта
+        top = max(coord[0] for coord in coords)    # Максимальная широта
+    return gr_name, date_start, [left, bottom, right, top]
+
+
+def make_config(ins_id):
+    return sh_session.make_config('9caa0952-9941-418e-8cc6-78eed98abe8f', 'k96k8JnL3mC4rNNDv7dsSItf1lntjPQN', ins_id)
+
+
+INSTANCE_ID = "8483249a-be2e-4d30-9272-597bcdbdf19e"
+# Пишется в папку гранулы, когда скачаны все тайлы и записаны их meta.json
+INGEST_DONE_FILENAME = ".ingested"
+
+
+def ingest_complete(granule_dir):
+    return os.path.exists(os.path.join(granule_dir, INGEST_DONE_FILENAME))
+
+
+def triage_granules(xml_paths, config, max_cloud_cover=None, batch_size=100):
+    """
+    Проверяет гранулы по каталогу до загрузки: одним постраничным запросом на batch_size гранул
+    узнаёт, есть ли гранула в архиве и какая у неё облачность.
+    :param xml_paths: Пути к MTD_MSIL1C.xml.
+    :param max_cloud_cover: Максимальная допустимая eo:cloud_cover в процентах (None - не фильтровать).
+    :return: (пути к xml прошедших гранул, отчёт - список словарей по всем гранулам)
+    """
+    granules = {}
+    for xml_path in xml_paths:
+        try:
+            granules[parse_file(xml_path)[0]] = xml_path
+        except Exception as e:
+            print(f"Error parsing {xml_path}: {e}")
+
+    catalog = sh_session.get_catalog(config)
+    cloud_cover = {}
+    granule_ids = list(granules)
+    for i in range(0, len(granule_ids), batch_size):
+        batch = granule_ids[i:i + batch_size]
+        for item in catalog.search(collection="sentinel-2-l1c", ids=batch, limit=batch_size):
+            cloud_cover[item["id"]] = item["properties"].get("eo:cloud_cover")
+
+    accepted = []
+    report = []
+    for gr_name, xml_path in granules.items():
+        available = gr_name in cloud_cover
+        cloud = cloud_cover.get(gr_name)
+        passed = available and (max_cloud_cover is None or (cloud is not None and cloud <= max_cloud_cover))
+        report.append({'granule': gr_name, 'xml': xml_path, 'available': available,
+                       'cloud_cover': cloud, 'accepted': passed})
+        if passed:
+            accepted.append(xml_path)
+        elif not available:
+            print(f"Granule {gr_name} not found in the catalog, skipping.")
+        else:
+            print(f"Granule {gr_name} cloud coverage {cloud} exceeds {max_cloud_cover}, skipping.")
+    return accepted, report
+
+
+def granule_grid(bbox, resolution=10):
+    """
+    Сетка тайлов гранулы: при стороне больше 2500 пикселей bbox режется на тайлы примерно по 2000 пикселей.
+    :return: (размер гранулы в пикселях, BBoxSplitter или None, если гранула качается одним запросом)
+    """
+    size = bbox_to_dimensions(bbox, resolution=resolution)
+    if size[0] <= 2500 and size[1] <= 2500:
+        return size, None
+    a, b = math.ceil(size[0] / 2000), math.ceil(size[1] / 2000)
+    return size, BBoxSplitter([bbox], CRS.WGS84, (a, b), reduce_bbox_sizes=True)
+
+
+def download_gridded_data(heavy_dir_xml, path_out, check_catalog=True):
     data = parse_file(heavy_dir_xml)
 
 
@@ -89,15 +135,7 @@ def download_gridded_data(heavy_dir_xml, path_out):
     time_interval_str =  f"{time_interval[0].strftime('%Y-%m-%dT%H:%M:%S.%fZ')}/{time_interval[1].strftime('%Y-%m-%dT%H:%M:%S.%fZ')}"
 
 
-    def make_config(ins_id):
-        config = SHConfig()
-        config.sh_client_id = '9caa0952-9941-418e-8cc6-78eed98abe8f'
-        config.sh_client_secret = 'k96k8JnL3mC4rNNDv7dsSItf1lntjPQN'
-        config.instance_id = ins_id
-        return (config)
-    from sentinelhub import SHConfig
-    config = make_config("8483249a-be2e-4d30-9272-597bcdbdf19e")
-    config.save()
+    config = make_config(INSTANCE_ID)
 
 
 
@@ -121,36 +159,45 @@ def download_gridded_data(heavy_dir_xml, path_out):
         return request
 
 
-    catalog = SentinelHubCatalog()
-    search_iterator = catalog.search(
-        collection="sentinel-2-l1c",
-        bbox=bbox, 
-        datetime=time_interval_str,
-        limit=10
-    )
-    results = list(search_iterator)
-    filtered_results = [result for result in results if granule_id in result["id"]]
-    if filtered_results:
-        for item in filtered_results:
-            print(f"Granule found: {item['id']}")
-            print(f"image cloud coverage is {filtered_results[0]['properties']['eo:cloud_cover']}")
+    # Если гранулы уже прошли triage_granules, повторный запрос к каталогу не нужен
+    if check_catalog:
+        catalog = sh_session.get_catalog(config)
+        search_iterator = catalog.search(
+            collection="sentinel-2-l1c",
+            bbox=bbox,
+            datetime=time_interval_str,
+            limit=10
+        )
+        results = list(search_iterator)
+        filtered_results = [result for result in results if granule_id in result["id"]]
+        if filtered_results:
+            for item in filtered_results:
+                print(f"Granule found: {item['id']}")
+                print(f"image cloud coverage is {filtered_results[0]['properties']['eo:cloud_cover']}")
 
-    else:
-        print("No results found matching the Granule ID.")
+        else:
+            print("No results found matching the Granule ID.")
 
-    os.mkdir(os.path.join(path_out, Path(heavy_dir_xml).parent.name))
-    size = bbox_to_dimensions(bbox, resolution=10)
+    granule_dir = os.path.join(path_out, Path(heavy_dir_xml).parent.name)
+    if ingest_complete(granule_dir):
+        print(f"Granule already downloaded: {granule_dir}")
+        return
+    # Папка может остаться от прерванной загрузки: уже сохранённые ответы клиент прочитает с диска
+    os.makedirs(granule_dir, exist_ok=True)
+    size, splitted_data = granule_grid(bbox)
     print(f"Image shape at {10} m resolution: {size} pixels")
-    if size[0] <= 2500 and size[1] <= 2500:
+    if splitted_data is None:
         download_data(bbox, time_interval, size, path_out)
     else:
-        a, b = math.ceil(size[0] / 2000), math.ceil(size[1] / 2000)
-        print(a, b)
-        splitted_data = BBoxSplitter([bbox], CRS.WGS84, (a, b), reduce_bbox_sizes=True)
         bbox_list = splitted_data.get_bbox_list()
         sh_requests = [download_data(sbbox, time_interval, bbox_to_dimensions(sbbox, resolution=10), path_out) for sbbox in bbox_list]
         dl_requests = [request.download_list[0] for request in sh_requests]
-        downloaded_data = SentinelHubDownloadClient(config=config).download(dl_requests, max_threads=10)
+        for request in dl_requests:
+            request_path, response_path = request.get_storage_paths()
+            # Сохранённый ответ без request.json клиент прочитать не может (сбой на записи meta.json) - качаем заново
+            if os.path.exists(response_path) and not os.path.exists(request_path):
+                os.remove(response_path)
+        downloaded_data = sh_session.get_download_client(config).download(dl_requests, max_threads=sh_session.POOL_SIZE)
         data_folder = sh_requests[0].data_folder
         tiffs = [Path(data_folder) / req.get_filename_list()[0] for req in sh_requests]
 
@@ -162,19 +209,53 @@ def download_gridded_data(heavy_dir_xml, path_out):
                 'index_x': splitted_data_info[i]['index_x'], 
                 'index_y': splitted_data_info[i]['index_y']
                 }
-        os.remove(os.path.join(path_out, Path(heavy_dir_xml).parent.name, fname, 'request.json'))
-        with open(os.path.join(path_out, Path(heavy_dir_xml).parent.name, fname, 'meta.json'), 'w') as dst:
+        request_file = os.path.join(granule_dir, fname, 'request.json')
+        if os.path.exists(request_file):
+            os.remove(request_file)
+        with open(os.path.join(granule_dir, fname, 'meta.json'), 'w') as dst:
             dst.write(json.dumps(meta))
+    open(os.path.join(granule_dir, INGEST_DONE_FILENAME), 'w').close()
+
+
+
+def list_granule_xmls(path_in, start=None, stop=None):
+    """
+    MTD_MSIL1C.xml гранул из path_in[start:stop] (по одной папке .SAFE на гранулу).
+    """
+    xml_paths = []
+    for el in os.listdir(path_in)[start:stop]:
+        xml_paths.append(os.path.join(path_in, el, os.listdir(os.path.join(path_in, el))[0], 'MTD_MSIL1C.xml'))
+    return xml_paths
+
+
+def ingest_granules(path_in, path_out, start=None, stop=None, triage=True, max_cloud_cover=None, report_file=None):
+    """
+    Скачивает гридированные данные для гранул из path_in (по одной папке .SAFE на гранулу).
+    :param start: Индекс первой гранулы в os.listdir(path_in).
+    :param stop: Индекс, на котором остановиться (не включительно).
+    :param triage: Перед загрузкой отсеять по каталогу отсутствующие в архиве и слишком облачные гранулы.
+    :param max_cloud_cover: Порог облачности для отсева, в процентах.
+    :param report_file: Куда сохранить отчёт triage в JSON.
+    """
+    os.makedirs(path_out, exist_ok=True)
+
+    xml_paths = list_granule_xmls(path_in, start, stop)
 
+    if triage:
+        xml_paths, report = triage_granules(xml_paths, make_config(INSTANCE_ID), max_cloud_cover)
+        print(f"{len(xml_paths)} of {len(report)} granules passed triage")
+        if report_file:
+            with open(report_file, 'w') as dst:
+                json.dump(report, dst, indent=2)
 
+    for xml_path in xml_paths:
+        print(xml_path)
 
-path_in = r"D:\omela\scoltech_150k\src"
-path_out = r'D:\omela\output_data_sentinel'
+        download_gridded_data(xml_path, path_out, check_catalog=not triage)
 
-os.makedirs(path_out, exist_ok=True)
 
-for el in os.listdir(path_in)[35:36]:
-    xml_path = os.path.join(path_in, el, os.listdir(os.path.join(path_in, el))[0], 'MTD_MSIL1C.xml')
-    print(xml_path)
+if __name__ == "__main__":
+    path_in = r"D:\omela\scoltech_150k\src"
+    path_out = r'D:\omela\output_data_sentinel'
 
-    download_gridded_data(xml_path, path_out)
+    ingest_granules(path_in, path_out, 35, 36, max_cloud_cover=30)
@@ -0,0 +1,153 @@
+import os
+import json
+import math
+import uuid
+import hashlib
+import numpy as np
+import band_cache
+
+
+# Пороги правила маски изменений: (ndwi < NDWI_THRESHOLD) & (first_ndvi - second_ndvi > DIFF_THRESHOLD)
+NDWI_THRESHOLD = 0.1
+DIFF_THRESHOLD = 0.2
+
+CACHE_DIRNAME = ".index_cache"
+
+
+def pixel_area_m2(transform, height, crs=None):
+    """
+    Площадь одного пикселя в м². Для WGS84 градусы переводятся в метры по широте центра тайла.
+    """
+    if crs is not None and not crs.is_geographic:
+        return abs(transform.a * transform.e)
+    center_lat = transform.f + transform.e * height / 2
+    dx = abs(transform.a) * 111320 * math.cos(math.radians(center_lat))
+    dy = abs(transform.e) * 110540
+    return dx * dy
+
+
+def file_signature(file_path):
+    """
+    Подпись входного файла для инвалидации кэша: путь, размер и время изменения.
+    """
+    stat = os.stat(file_path)
+    return {"path": os.path.abspath(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _signature_key(*signatures):
+    return hashlib.sha1(json.dumps(signatures, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _read_bands(file_path, count):
+    bands, _ = band_cache.read_bands(file_path)
+    if len(bands) < count:
+        raise ValueError(f"Недостаточно бэндов в {file_path} (требуется {count}, найдено {len(bands)})")
+    return [bands[i] for i in range(count)]
+
+
+def _cached(cache_dir, name, signature, compute):
+    """
+    Возвращает растр name из кэша, если он посчитан для той же подписи входа, иначе считает и сохраняет.
+    """
+    cache_file = os.path.join(cache_dir, f"{name}_{_signature_key(signature)}.npy")
+    if os.path.exists(cache_file):
+        try:
+            return np.load(cache_file)
+        except FileNotFoundError:
+            pass  # Удалён другим процессом, пересчитавшим растр для нового входа
+
+    data = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    # Старые версии этого растра больше не нужны; недописанные .tmp.npy других процессов не трогаем
+    for old_file in os.listdir(cache_dir):
+        old_path = os.path.join(cache_dir, old_file)
+        if (old_file.startswith(f"{name}_") and old_file.endswith(".npy") and not old_file.endswith(".tmp.npy")
+                and old_path != cache_file):
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+    tmp_file = f"{cache_file}.{uuid.uuid4().hex}.tmp.npy"
+    np.save(tmp_file, data)
+    os.replace(tmp_file, cache_file)
+    return data
+
+
+def load_or_compute_indices(bands_path, response_path, cache_dir=None):
+    """
+    Индексы тайла с кэшированием на диске. Каждый растр зависит только от своего входа:
+    first_ndvi - от bands.tiff, second_ndvi и ndwi - от response.tiff.
+    :param bands_path: Путь к bands.tiff (B04, B08).
+    :param response_path: Путь к response.tiff (B03, B04, B08, CLM).
+    :param cache_dir: Папка кэша, по умолчанию .index_cache рядом с response.tiff.
+    :return: Словарь {'first_ndvi', 'second_ndvi', 'ndwi'}.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(response_path), CACHE_DIRNAME)
+    bands_sig = file_signature(bands_path)
+    response_sig = file_signature(response_path)
+    comp_bands = {}
+
+    def first_ndvi():
+        B04old, B08old = _read_bands(bands_path, 2)
+        return (B08old - B04old) / (B08old + B04old + 1e-8)
+
+    def comparison_bands():
+        if not comp_bands:
+            comp_bands["B03"], comp_bands["B04"], comp_bands["B08"] = _read_bands(response_path, 3)
+        return comp_bands
+
+    def second_ndvi():
+        b = comparison_bands()
+        return (b["B08"] - b["B04"]) / (b["B08"] + b["B04"] + 1e-8)
+
+    def ndwi():
+        b = comparison_bands()
+        return (b["B03"] - b["B08"]) / (b["B03"] + b["B08"] + 1e-8)
+
+    return {
+        "first_ndvi": _cached(cache_dir, "first_ndvi", bands_sig, first_ndvi),
+        "second_ndvi": _cached(cache_dir, "second_ndvi", response_sig, second_ndvi),
+        "ndwi": _cached(cache_dir, "ndwi", response_sig, ndwi),
+    }
+
+
+def build_change_mask(indices, ndwi_threshold=NDWI_THRESHOLD, diff_threshold=DIFF_THRESHOLD):
+    """
+    Дешёвый шаг пороговой классификации по уже посчитанным индексам.
+    """
+    return (indices["ndwi"] < ndwi_threshold) & ((indices["first_ndvi"] - indices["second_ndvi"]) > diff_threshold)
+
+
+def mask_params(bands_path, response_path, ndwi_threshold=NDWI_THRESHOLD, diff_threshold=DIFF_THRESHOLD, **extra):
+    """
+    Параметры, от которых зависит маска: пороги и подписи входных файлов.
+    """
+    params = {
+        "ndwi_threshold": ndwi_threshold,
+        "diff_threshold": diff_threshold,
+        "bands": file_signature(bands_path),
+        "response": file_signature(response_path),
+    }
+    params.update(extra)
+    return params
+
+
+def _params_file(output_file):
+    return os.path.splitext(output_file)[0] + ".params.json"
+
+
+def output_is_current(output_file, params):
+    """
+    True, если output_file существует и был получен с теми же параметрами и входами.
+    """
+    params_file = _params_file(output_file)
+    if not os.path.exists(output_file) or not os.path.exists(params_file):
+        return False
+    with open(params_file, "r") as f:
+        return json.load(f) == json.loads(json.dumps(params))
+
+
+def write_output_params(output_file, params):
+    with open(_params_file(output_file), "w") as f:
+        json.dump(params, f)
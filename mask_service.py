@@ -0,0 +1,264 @@
+"""
+Локальный HTTP-сервис, который по запросу строит маску изменений для области интереса (AOI).
+
+    POST /mask  {"aoi": <GeoJSON geometry> или [minx, miny, maxx, maxy],
+                 "start_date": "2023-05-02", "end_date": "2023-09-30",
+                 "ndwi_threshold": 0.1, "diff_threshold": 0.2}
+    GET  /health
+
+Сервис находит тайлы output_data_sentinel, пересекающие AOI, и для каждого:
+- берёт bands.tiff из new_band_data, если его дата (dates.json) попадает в окно дат,
+  иначе ищет дату сам (облачный профиль + compare_masks, при неудаче - безоблачная композиция)
+  и кладёт бэнды в свой кэш;
+- берёт mask.geojson основного прогона, если он построен с теми же порогами, иначе строит
+  маску в кэше сервиса через mask_stage.process_tile (он пропускает уже посчитанные маски).
+Ответ - GeoJSON FeatureCollection, обрезанный по AOI; признаки отдаются потоком по мере готовности
+тайлов. Одновременные запросы с пересекающимися AOI делят работу по общим тайлам.
+"""
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shapely.geometry import box, shape, mapping
+from index_cache import NDWI_THRESHOLD, DIFF_THRESHOLD, CACHE_DIRNAME
+
+DEFAULT_START_DATE = "2023-05-02"
+DEFAULT_END_DATE = "2023-09-30"
+
+
+def load_tile_index(comparison_dir):
+    """
+    Границы всех тайлов: {(гранула, тайл): shapely-прямоугольник}.
+    """
+    from clear_dates import load_tile_bbox
+
+    index = {}
+    for granule in sorted(os.listdir(comparison_dir)):
+        granule_dir = os.path.join(comparison_dir, granule)
+        if not os.path.isdir(granule_dir):
+            continue
+        for tile in sorted(os.listdir(granule_dir)):
+            tile_dir = os.path.join(granule_dir, tile)
+            if os.path.exists(os.path.join(tile_dir, "response.tiff")):
+                index[(granule, tile)] = box(*load_tile_bbox(tile_dir))
+    return index
+
+
+def parse_aoi(aoi):
+    """
+    AOI из bbox [minx, miny, maxx, maxy], GeoJSON-геометрии или Feature (WGS84).
+    """
+    if isinstance(aoi, (list, tuple)):
+        return box(*aoi)
+    if aoi.get("type") == "Feature":
+        aoi = aoi["geometry"]
+    return shape(aoi)
+
+
+class MaskService:
+    """
+    Состояние сервиса: индекс тайлов, пул потоков для тайлов и задания в работе.
+    """
+
+    def __init__(self, comparison_dir, bands_dir, cache_dir, instance_id, workers=4, vectorize_options=None):
+        self.comparison_dir = comparison_dir
+        self.bands_dir = bands_dir
+        self.cache_dir = cache_dir
+        self.instance_id = instance_id
+        self.vectorize_options = vectorize_options or {}
+        self.tiles = load_tile_index(comparison_dir)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.RLock()
+        self.in_flight = {}
+        self.download_locks = {}
+
+    def cached_bands(self, granule, tile, start_date, end_date):
+        """
+        bands.tiff основного прогона, если его дата попадает в окно [start_date, end_date].
+        """
+        from clear_dates import DATES_FILENAME, read_dates
+
+        dates_file = os.path.join(self.bands_dir, granule, DATES_FILENAME)
+        bands_path = os.path.join(self.bands_dir, granule, tile, "bands.tiff")
+        if not os.path.exists(dates_file) or not os.path.exists(bands_path):
+            return None
+        entry = read_dates(dates_file)[0].get(tile)
+        if not entry:
+            return None
+        if entry.get("composite"):
+            return bands_path if entry["composite"] == [start_date, end_date] else None
+        return bands_path if start_date <= entry["date"] <= end_date else None
+
+    def download_bands(self, granule, tile, start_date, end_date, tile_cache):
+        """
+        Ищет дату для тайла в окне и скачивает бэнды в кэш сервиса.
+        """
+        bands_path = os.path.join(tile_cache, "bands.tiff")
+        # Запросы с разными порогами для одного тайла и окна скачивают бэнды один раз
+        with self.lock:
+            download_lock = self.download_locks.setdefault(tile_cache, threading.Lock())
+        with download_lock:
+            if not os.path.exists(bands_path):
+                self.search_and_download(granule, tile, start_date, end_date, tile_cache)
+        return bands_path
+
+    def search_and_download(self, granule, tile, start_date, end_date, tile_cache):
+        import rasterio
+        from clear_dates import (make_config, load_tile_bbox, download_clm_profile, rank_candidate_dates,
+                                 find_tile_date, download_new_bands, download_composite_bands)
+
+        config = make_config(self.instance_id)
+        tile_dir = os.path.join(self.comparison_dir, granule, tile)
+        with rasterio.open(os.path.join(tile_dir, "response.tiff")) as src:
+            tile_info = {"bbox": load_tile_bbox(tile_dir), "size": [src.width, src.height], "clm": src.read(4)}
+        season_interval = (f"{start_date}T00:00:00Z", f"{end_date}T23:59:59Z")
+
+        match = None
+        try:
+            profile = download_clm_profile(tile_info["bbox"], season_interval, config, tile_info["size"])
+            match = find_tile_date(tile_info, rank_candidate_dates(profile), config)
+        except Exception as e:
+            print(f"Error searching date for {granule}/{tile}: {e}")
+        if match:
+            download_new_bands(tile_info["bbox"], match[1], config, tile_info["size"], tile_cache)
+        else:
+            # Совпадающей по облачности даты нет - берётся безоблачная композиция за всё окно
+            download_composite_bands(tile_info["bbox"], season_interval, config, tile_info["size"], tile_cache)
+
+    def build_tile_mask(self, granule, tile, start_date, end_date, ndwi_threshold, diff_threshold):
+        """
+        Маска одного тайла для окна дат: кэшированные бэнды и маски переиспользуются.
+        :return: Путь к mask.geojson.
+        """
+        from mask_stage import process_tile
+        from index_cache import mask_params, output_is_current
+
+        response_path = os.path.join(self.comparison_dir, granule, tile, "response.tiff")
+        window_cache = os.path.join(self.cache_dir, f"{start_date}_{end_date}", granule, tile)
+        bands_path = self.cached_bands(granule, tile, start_date, end_date)
+        # Индексы кэшируются на тайл и бэнды, а не на пороги: для бэндов основного прогона - его кэш
+        # рядом с response.tiff, для скачанных сервисом - кэш окна дат
+        index_cache_dir = None
+        if bands_path:
+            # Маска основного прогона подходит, если она построена с теми же порогами
+            main_geojson = os.path.join(os.path.dirname(response_path), "mask.geojson")
+            params = mask_params(bands_path, response_path, ndwi_threshold, diff_threshold, **self.vectorize_options)
+            if output_is_current(main_geojson, params):
+                return main_geojson
+        else:
+            bands_path = self.download_bands(granule, tile, start_date, end_date, window_cache)
+            index_cache_dir = os.path.join(window_cache, CACHE_DIRNAME)
+        # Маски с другими порогами пишутся в кэш сервиса, основные результаты не перезаписываются
+        output_geojson = os.path.join(window_cache, f"t{ndwi_threshold}_{diff_threshold}", "mask.geojson")
+        return process_tile(bands_path, response_path, ndwi_threshold, diff_threshold, self.vectorize_options,
+                            output_geojson=output_geojson, index_cache_dir=index_cache_dir)
+
+    def submit_tile(self, key):
+        """
+        Одно задание на тайл и набор параметров: повторные запросы получают тот же Future.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.executor.submit(self.build_tile_mask, *key)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda _, key=key: self.forget(key))
+            return future
+
+    def forget(self, key):
+        with self.lock:
+            self.in_flight.pop(key, None)
+
+    def iter_features(self, aoi, start_date, end_date, ndwi_threshold=NDWI_THRESHOLD, diff_threshold=DIFF_THRESHOLD):
+        """
+        Признаки GeoJSON маски, обрезанные по AOI, по мере готовности тайлов.
+        """
+        futures = {}
+        for (granule, tile), bounds in self.tiles.items():
+            if bounds.intersects(aoi):
+                key = (granule, tile, start_date, end_date, ndwi_threshold, diff_threshold)
+                futures[self.submit_tile(key)] = (granule, tile)
+
+        for future in as_completed(futures):
+            granule, tile = futures[future]
+            try:
+                mask_file = future.result()
+            except Exception as e:
+                print(f"Ошибка маски {granule}/{tile}: {e}")
+                continue
+            if not mask_file:
+                continue
+            with open(mask_file, "r") as f:
+                features = json.load(f)["features"]
+            for feature in features:
+                clipped = shape(feature["geometry"]).intersection(aoi)
+                if not clipped.is_empty:
+                    yield {"type": "Feature", "geometry": mapping(clipped),
+                           "properties": {"granule": granule, "tile": tile}}
+
+
+def make_handler(service):
+    class MaskRequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {"tiles": len(service.tiles), "in_flight": len(service.in_flight)})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/mask":
+                self.send_json(404, {"error": "not found"})
+                return
+            try:
+                query = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                aoi = parse_aoi(query["aoi"])
+                start_date = query.get("start_date", DEFAULT_START_DATE)
+                end_date = query.get("end_date", DEFAULT_END_DATE)
+                if datetime.strptime(start_date, "%Y-%m-%d") > datetime.strptime(end_date, "%Y-%m-%d"):
+                    raise ValueError(f"start_date {start_date} is after end_date {end_date}")
+                ndwi_threshold = float(query.get("ndwi_threshold", NDWI_THRESHOLD))
+                diff_threshold = float(query.get("diff_threshold", DIFF_THRESHOLD))
+            except Exception as e:
+                self.send_json(400, {"error": f"bad request: {e}"})
+                return
+
+            # Ответ без Content-Length: признаки пишутся по мере готовности, конец - закрытие соединения
+            self.send_response(200)
+            self.send_header("Content-Type", "application/geo+json")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(b'{"type": "FeatureCollection", "features": [')
+            first = True
+            for feature in service.iter_features(aoi, start_date, end_date, ndwi_threshold, diff_threshold):
+                self.wfile.write((b"" if first else b",") + json.dumps(feature).encode())
+                self.wfile.flush()
+                first = False
+            self.wfile.write(b"]}")
+            self.close_connection = True
+
+    return MaskRequestHandler
+
+
+def serve(comparison_dir, bands_dir, cache_dir, instance_id, host="127.0.0.1", port=8765, workers=4,
+          vectorize_options=None):
+    service = MaskService(comparison_dir, bands_dir, cache_dir, instance_id, workers, vectorize_options)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Сервис масок: http://{host}:{port} ({len(service.tiles)} тайлов)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Остановка сервиса")
+    finally:
+        server.server_close()
+        service.executor.shutdown(wait=False)
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import rasterio
+from tile_stream import find_tiff_files_by_subfolder
+from vectorize import clean_mask, save_mask_to_geojson
+from tile_stats import tile_summary, comparison_date, write_tile_stats, has_tile_stats
+from rle_mask import RLE_FILENAME, encode, save_rle
+from index_cache import (
+    NDWI_THRESHOLD, DIFF_THRESHOLD, pixel_area_m2, load_or_compute_indices, build_change_mask,
+    mask_params, output_is_current, write_output_params
+)
+
+
+def iter_granule_tiles(path_2023, path_comparison):
+    """
+    Перебирает пары (bands.tiff, response.tiff) по всем гранулам, сопоставляя их по подпапкам.
+    :return: Кортежи (гранула, подпапка, путь к bands.tiff, путь к response.tiff).
+    """
+    for folder in os.listdir(path_2023):
+        path_to_folder_2023 = os.path.join(path_2023, folder)
+        path_to_orig_folder = os.path.join(path_comparison, folder)
+
+        if not os.path.isdir(path_to_folder_2023) or not os.path.isdir(path_to_orig_folder):
+            continue
+
+        # Сопоставление подпапок с файлами bands.tiff и response.tiff
+        bands_2023_dict = find_tiff_files_by_subfolder(path_to_folder_2023, "bands.tiff")
+        response_comp_dict = find_tiff_files_by_subfolder(path_to_orig_folder, "response.tiff")
+
+        common_subfolders = set(bands_2023_dict.keys()) & set(response_comp_dict.keys())
+
+        if not common_subfolders:
+            print(f"Нет общих подпапок с файлами в {folder}")
+            continue
+
+        for subfolder in sorted(common_subfolders):
+            yield folder, subfolder, bands_2023_dict[subfolder], response_comp_dict[subfolder]
+
+
+def index_granules(path_2023, path_comparison):
+    """
+    Считает и кэширует NDVI/NDWI для всех тайлов (без построения масок).
+    """
+    for folder, subfolder, bands_path, response_path in iter_granule_tiles(path_2023, path_comparison):
+        try:
+            load_or_compute_indices(bands_path, response_path)
+            print(f"Индексы готовы: {folder}/{subfolder}")
+        except Exception as e:
+            print(f"Ошибка загрузки файлов в {subfolder}: {e}")
+
+
+def process_tile(bands_path, response_path, ndwi_threshold=NDWI_THRESHOLD, diff_threshold=DIFF_THRESHOLD,
+                 vectorize_options=None, stats_db=None, output_geojson=None, index_cache_dir=None):
+    """
+    Строит mask.geojson (и mask.rle.npz) рядом с response.tiff, если маска отсутствует или получена
+    с другими параметрами.
+    :param stats_db: Файл SQLite, куда в том же проходе пишется строка сводной статистики тайла.
+    :param output_geojson: Другой путь для маски (по умолчанию mask.geojson рядом с response.tiff).
+    :param index_cache_dir: Папка кэша индексов (по умолчанию .index_cache рядом с response.tiff). Не зависит
+        от порогов: маски с другими порогами берут те же NDVI/NDWI.
+    :return: Путь к маске или None, если тайл пропущен из-за ошибки.
+    """
+    started = time.perf_counter()
+    vectorize_options = vectorize_options or {}
+    output_geojson = output_geojson or os.path.join(os.path.dirname(response_path), "mask.geojson")
+
+    tile_dir = os.path.dirname(response_path)
+    granule, tile = os.path.basename(os.path.dirname(tile_dir)), os.path.basename(tile_dir)
+
+    # Маска пропускается, только если она получена с теми же порогами и из тех же файлов
+    params = mask_params(bands_path, response_path, ndwi_threshold, diff_threshold, **vectorize_options)
+    if output_is_current(output_geojson, params):
+        print(f"Маска уже существует: {output_geojson}, пропускаем...")
+        # Для уже обработанного архива строка статистики дописывается, если её ещё нет
+        if stats_db and not has_tile_stats(stats_db, granule, tile, ndwi_threshold, diff_threshold):
+            _build_tile_outputs(bands_path, response_path, ndwi_threshold, diff_threshold, vectorize_options,
+                                stats_db, output_geojson, index_cache_dir, params, started, write_outputs=False)
+        return output_geojson
+
+    return _build_tile_outputs(bands_path, response_path, ndwi_threshold, diff_threshold, vectorize_options,
+                               stats_db, output_geojson, index_cache_dir, params, started)
+
+
+def _build_tile_outputs(bands_path, response_path, ndwi_threshold, diff_threshold, vectorize_options, stats_db,
+                        output_geojson, index_cache_dir, params, started, write_outputs=True):
+    """
+    Маска тайла и строка статистики по очищенной маске (той, что попадает в mask.geojson).
+    :param write_outputs: False - только статистика: mask.geojson уже актуален, число полигонов берётся из него.
+    """
+    tile_dir = os.path.dirname(response_path)
+
+    try:
+        # Индексы берутся из кэша, пересчитываются только при изменении входных файлов
+        indices = load_or_compute_indices(bands_path, response_path, index_cache_dir)
+    except Exception as e:
+        print(f"Ошибка загрузки файлов в {os.path.dirname(response_path)}: {e}")
+        return None
+
+    # Создание и сохранение маски
+    mask = build_change_mask(indices, ndwi_threshold, diff_threshold)
+    cleaned = clean_mask(mask, vectorize_options.get("min_pixels", 0),
+                         vectorize_options.get("closing_iterations", 0)).astype(bool)
+    with rasterio.open(response_path) as src:
+        transform = src.transform
+        crs = src.crs
+        if stats_db:
+            clm = src.read(4) if src.count >= 4 else None
+            pixel_area = pixel_area_m2(src.transform, src.height, src.crs)
+
+    if write_outputs:
+        polygon_count = save_mask_to_geojson(cleaned, transform, output_geojson,
+                                             simplify_m=vectorize_options.get("simplify_m", 0))
+        # Исходная (до очистки) маска в сериях - для быстрых сравнений площадей между порогами и прогонами
+        save_rle(encode(mask, transform, crs), os.path.join(os.path.dirname(output_geojson), RLE_FILENAME))
+        write_output_params(output_geojson, params)
+    else:
+        with open(output_geojson, "r") as f:
+            polygon_count = len(json.load(f)["features"])
+
+    if stats_db:
+        summary = tile_summary(cleaned, indices, clm, pixel_area, polygon_count, ndwi_threshold)
+        write_tile_stats(stats_db, os.path.basename(os.path.dirname(tile_dir)), os.path.basename(tile_dir),
+                         summary, comparison_date(bands_path), ndwi_threshold, diff_threshold,
+                         time.perf_counter() - started)
+    return output_geojson
+
+
+def vectorize_granules(path_2023, path_comparison, ndwi_threshold=NDWI_THRESHOLD, diff_threshold=DIFF_THRESHOLD,
+                       vectorize_options=None, stats_db=None):
+    """
+    Строит маски изменений для всех тайлов всех гранул.
+    """
+    for folder, subfolder, bands_path, response_path in iter_granule_tiles(path_2023, path_comparison):
+        process_tile(bands_path, response_path, ndwi_threshold, diff_threshold, vectorize_options, stats_db)
@@ -0,0 +1,225 @@
+"""
+Оценка стоимости прогона до запуска: сколько запросов, processing units (PU), байт и времени
+уйдёт на ingest, поиск дат и загрузку бэндов для набора гранул.
+
+Сетка тайлов считается точно, по следам гранул из MTD_MSIL1C.xml и той же логикой, что
+в download_gridded_data (get_gridded_data.granule_grid). Число проб при поиске дат - ожидание:
+по умолчанию худший случай (перебор всего окна), а если есть результаты прошлых прогонов
+(dates.json), то среднее число дней до совпадения по ним.
+
+PU считаются по правилам Sentinel Hub: (ширина * высота / 512², не меньше 0.01) * (входных
+каналов / 3, dataMask не считается) * (2 для FLOAT32) * число наблюдений, но не меньше 0.005
+на запрос. Байты - размер несжатого ответа. Время - сумма задержек запросов (из журнала
+SH_LATENCY_FILE, см. sh_session) на число одновременных запросов.
+"""
+import os
+import json
+import math
+from datetime import datetime
+from sentinelhub import BBox, CRS, bbox_to_dimensions
+from get_gridded_data import parse_file, granule_grid
+from clear_dates import DATES_FILENAME, read_dates
+
+STAGES = ["ingest", "dates", "bands"]
+# Задержки запросов по умолчанию, секунды (если журнала нет или в нём нет такого типа)
+DEFAULT_LATENCIES = {"process": 4.0, "statistics": 6.0, "catalog": 1.0}
+# Повторный пролёт Sentinel-2 (два спутника), дни - число наблюдений в композиции
+REVISIT_DAYS = 5
+CATALOG_BATCH = 100
+
+
+def request_pu(size, input_bands, float32=True, samples=1):
+    """
+    PU одного запроса Process/Statistical API.
+    :param size: Размер ответа в пикселях [w, h].
+    :param input_bands: Число входных каналов без dataMask.
+    :param samples: Число наблюдений (дат), которые обрабатывает запрос.
+    """
+    area_factor = max(size[0] * size[1] / 512 ** 2, 0.01)
+    return max(area_factor * input_bands / 3 * (2 if float32 else 1) * samples, 0.005)
+
+
+def response_bytes(size, output_bands, sample_bytes=4):
+    return size[0] * size[1] * output_bands * sample_bytes
+
+
+def load_latencies(latency_file=None):
+    """
+    Средняя задержка по типам запросов из журнала sh_session.save_latency_log.
+    """
+    latencies = dict(DEFAULT_LATENCIES)
+    if latency_file and os.path.exists(latency_file):
+        with open(latency_file, "r") as f:
+            for kind, entry in json.load(f).items():
+                if entry["count"]:
+                    latencies[kind] = entry["total_s"] / entry["count"]
+    return latencies
+
+
+def historical_probes(bands_dir, start_date):
+    """
+    Сколько дней до совпадения перебирал поиск в прошлых прогонах с тем же началом окна
+    (режимы daily и hierarchical идут по дням от start_date).
+    :return: (среднее по тайлам, среднее по гранулам максимума по тайлам) или None, если истории нет.
+    """
+    tile_days, granule_days = [], []
+    for granule in sorted(os.listdir(bands_dir)):
+        dates_file = os.path.join(bands_dir, granule, DATES_FILENAME)
+        if not os.path.exists(dates_file):
+            continue
+        found, _ = read_dates(dates_file)
+        days = [(datetime.strptime(entry["date"], "%Y-%m-%d") - start_date).days + 1
+                for entry in found.values() if entry.get("date")]
+        days = [d for d in days if d > 0]
+        if days:
+            tile_days.extend(days)
+            granule_days.append(max(days))
+    if not tile_days:
+        return None
+    return sum(tile_days) / len(tile_days), sum(granule_days) / len(granule_days)
+
+
+def granule_tiles(xml_path):
+    """
+    Тайлы гранулы так, как их скачает download_gridded_data.
+    :return: (BBox гранулы, список размеров тайлов [w, h])
+    """
+    _, _, coords = parse_file(xml_path)
+    bbox = BBox(bbox=coords, crs=CRS.WGS84)
+    size, splitter = granule_grid(bbox)
+    if splitter is None:
+        return bbox, [list(size)]
+    return bbox, [list(bbox_to_dimensions(sbbox, resolution=10)) for sbbox in splitter.get_bbox_list()]
+
+
+def empty_stage():
+    return {"requests": {}, "pu": 0.0, "bytes": 0}
+
+
+def add_requests(stage, kind, count, pu=0.0, size=None, output_bands=0):
+    """
+    Добавляет к этапу count одинаковых запросов типа kind стоимостью pu и с ответом size x output_bands.
+    """
+    stage["requests"][kind] = stage["requests"].get(kind, 0) + count
+    stage["pu"] += count * pu
+    if size:
+        stage["bytes"] += count * response_bytes(size, output_bands)
+
+
+def plan_granule(stages, tile_sizes, granule_bbox, window_days, search_mode, max_candidates,
+                 tile_probes, granule_probes):
+    """
+    Добавляет к stages запросы одной гранулы.
+    :param tile_probes: Ожидаемое число дат, перебираемых для тайла до совпадения.
+    :param granule_probes: Ожидаемое число дат, перебираемых для всей гранулы (режим hierarchical).
+    """
+    ingest, dates, bands = stages["ingest"], stages["dates"], stages["bands"]
+    for size in tile_sizes:
+        # download_data: B03, B04, B08, CLM в FLOAT32, одна сцена за ±1 ч
+        add_requests(ingest, "process", 1, request_pu(size, 4), size, 4)
+
+        clm_pu = request_pu(size, 1)
+        if search_mode == "profile":
+            profile_size = (max(1, size[0] // 6), max(1, size[1] // 6))
+            add_requests(dates, "statistics", 1, request_pu(profile_size, 1, samples=window_days))
+            add_requests(dates, "process", min(tile_probes, max_candidates), clm_pu, size, 1)
+        elif search_mode == "daily":
+            add_requests(dates, "process", tile_probes, clm_pu, size, 1)
+        elif search_mode == "hierarchical":
+            # Полноразмерная проверка - обычно только на дате совпадения
+            add_requests(dates, "process", 1, clm_pu, size, 1)
+
+        if search_mode == "composite":
+            # download_composite_bands: ORBIT-мозаика B04, B08, CLM за всё окно, 4 канала на выходе
+            orbits = max(1, math.ceil(window_days / REVISIT_DAYS))
+            add_requests(bands, "process", 1, request_pu(size, 3, samples=orbits), size, 4)
+        else:
+            add_requests(bands, "process", 1, request_pu(size, 2), size, 2)
+
+    if search_mode == "hierarchical":
+        # Одна грубая CLM-маска (160 м) на всю гранулу за каждую перебранную дату
+        coarse_size = bbox_to_dimensions(granule_bbox, resolution=160)
+        add_requests(dates, "process", granule_probes, request_pu(coarse_size, 1), coarse_size, 1)
+
+
+def plan_run(xml_paths, start_date, end_date, search_mode="hierarchical", max_candidates=5,
+             expected_probes=None, history_dir=None, latencies=None, concurrency=10, triage=True):
+    """
+    Оценка прогона по списку MTD_MSIL1C.xml.
+    :param expected_probes: Ожидаемое число дней перебора на тайл (None - по истории или всё окно).
+    :param history_dir: Папка прошлых dates.json (new_band_data) для оценки числа проб.
+    :param latencies: Словарь {тип запроса: секунды} (load_latencies).
+    :param concurrency: Число одновременных запросов (потоков загрузки на все узлы).
+    :return: Словарь с числом гранул и тайлов, запросами, PU и байтами по этапам и оценкой времени.
+    """
+    latencies = latencies or load_latencies()
+    window_days = (end_date - start_date).days + 1
+    tile_probes = granule_probes = window_days
+    # История есть смысл брать только для режимов, которые перебирают дни от start_date
+    history = None
+    if history_dir and search_mode in ("daily", "hierarchical"):
+        history = historical_probes(history_dir, start_date)
+    if expected_probes is not None:
+        tile_probes = granule_probes = expected_probes
+    elif history:
+        tile_probes, granule_probes = history
+    probes_from = "option" if expected_probes is not None else "history" if history else "worst case"
+    if search_mode == "composite":
+        tile_probes = granule_probes = 0
+        probes_from = "no search"
+    elif search_mode == "profile" and expected_probes is None:
+        tile_probes = granule_probes = max_candidates
+        probes_from = "max candidates"
+    tile_probes = min(math.ceil(tile_probes), window_days)
+    granule_probes = min(math.ceil(granule_probes), window_days)
+
+    stages = {stage: empty_stage() for stage in STAGES}
+    granules = tiles = 0
+    for xml_path in xml_paths:
+        try:
+            granule_bbox, tile_sizes = granule_tiles(xml_path)
+        except Exception as e:
+            print(f"Error parsing {xml_path}: {e}")
+            continue
+        granules += 1
+        tiles += len(tile_sizes)
+        plan_granule(stages, tile_sizes, granule_bbox, window_days, search_mode, max_candidates,
+                     tile_probes, granule_probes)
+    if triage and granules:
+        add_requests(stages["ingest"], "catalog", math.ceil(granules / CATALOG_BATCH))
+
+    for stage in stages.values():
+        busy = sum(count * latencies.get(kind, DEFAULT_LATENCIES["process"])
+                   for kind, count in stage["requests"].items())
+        stage["runtime_s"] = busy / max(concurrency, 1)
+        stage["pu"] = round(stage["pu"], 2)
+    return {
+        "granules": granules,
+        "tiles": tiles,
+        "search_mode": search_mode,
+        "window_days": window_days,
+        "tile_probes": tile_probes,
+        "granule_probes": granule_probes,
+        "probes_from": probes_from,
+        "concurrency": concurrency,
+        "latencies": latencies,
+        "stages": stages,
+        "total": {
+            "requests": sum(sum(stage["requests"].values()) for stage in stages.values()),
+            "pu": round(sum(stage["pu"] for stage in stages.values()), 2),
+            "bytes": sum(stage["bytes"] for stage in stages.values()),
+            "runtime_s": sum(stage["runtime_s"] for stage in stages.values()),
+        },
+    }
+
+
+def print_plan(plan):
+    print(f"Гранул: {plan['granules']}, тайлов: {plan['tiles']}, режим поиска: {plan['search_mode']}, "
+          f"окно: {plan['window_days']} дн.")
+    print(f"Проб на тайл: {plan['tile_probes']}, на гранулу: {plan['granule_probes']} ({plan['probes_from']})")
+    print(f"{'этап':10} {'запросы':>10} {'PU':>12} {'ГБ':>10} {'часы':>8}")
+    for name, stage in list(plan["stages"].items()) + [("итого", plan["total"])]:
+        requests = stage["requests"] if isinstance(stage["requests"], int) else sum(stage["requests"].values())
+        print(f"{name:10} {requests:>10} {stage['pu']:>12.1f} {stage['bytes'] / 1024 ** 3:>10.2f} "
+              f"{stage['runtime_s'] / 3600:>8.2f}")
+    print(f"Одновременных запросов: {plan['concurrency']}")
@@ -0,0 +1,213 @@
+"""
+Быстрые превью (quick-look) тайлов и гранул для визуального контроля.
+
+Для каждого тайла рядом с response.tiff пишется preview.png из трёх панелей:
+ложные цвета (B08, B04, B03) с контуром mask.geojson, разность NDVI (2023 - сравнение)
+и маска изменений. Каналы читаются с прореживанием (out_shape), так что GDAL берёт
+обзорные уровни GeoTIFF, если они есть, и не декодирует полное разрешение.
+Для гранулы тайлы собираются в одну мозаику <гранула>/preview.png по индексам из meta.json.
+Превью пересоздаётся, только если исходные файлы новее него.
+"""
+import os
+import json
+import math
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.features import rasterize
+from mask_stage import iter_granule_tiles
+
+PREVIEW_FILENAME = "preview.png"
+MASK_FILENAME = "mask.geojson"
+
+
+def read_decimated(file_path, bands, factor, shape=None):
+    """
+    Читает каналы bands (нумерация rasterio), уменьшенные в factor раз.
+    :param shape: Точный размер (высота, ширина) результата, если нужно совпасть с другим растром.
+    :return: (массив [каналы, высота, ширина], transform уменьшенного растра)
+    """
+    with rasterio.open(file_path) as src:
+        height, width = shape or (max(src.height // factor, 1), max(src.width // factor, 1))
+        data = src.read(bands, out_shape=(len(bands), height, width), resampling=Resampling.nearest)
+        transform = src.transform * src.transform.scale(src.width / width, src.height / height)
+    return data.astype(np.float32), transform
+
+
+def stretch(band, low=2, high=98):
+    """
+    Линейное растяжение канала по перцентилям в uint8.
+    """
+    valid = band[np.isfinite(band)]
+    if not valid.size:
+        return np.zeros(band.shape, dtype=np.uint8)
+    lo, hi = np.percentile(valid, (low, high))
+    scaled = (np.nan_to_num(band, nan=lo) - lo) / (hi - lo + 1e-8)
+    return (np.clip(scaled, 0, 1) * 255).astype(np.uint8)
+
+
+def diverging(values, limit=0.5):
+    """
+    Палитра для разности NDVI: синий (рост) - белый - красный (падение).
+    """
+    t = np.clip(np.nan_to_num(values) / limit, -1, 1)
+    rgb = np.full((3,) + values.shape, 255, dtype=np.float32)
+    rgb[1] -= np.abs(t) * 255
+    rgb[0] -= np.where(t < 0, -t, 0) * 255
+    rgb[2] -= np.where(t > 0, t, 0) * 255
+    return rgb.astype(np.uint8)
+
+
+def mask_outline(geojson_file, shape, transform):
+    """
+    Растеризует контуры полигонов маски на сетку превью.
+    :return: (заливка, контур) - bool-массивы.
+    """
+    if not os.path.exists(geojson_file):
+        return np.zeros(shape, dtype=bool), np.zeros(shape, dtype=bool)
+    with open(geojson_file, "r") as f:
+        geometries = [feature["geometry"] for feature in json.load(f)["features"]]
+    if not geometries:
+        return np.zeros(shape, dtype=bool), np.zeros(shape, dtype=bool)
+    fill = rasterize(geometries, out_shape=shape, transform=transform, dtype=np.uint8).astype(bool)
+    boundaries = [{"type": "MultiLineString", "coordinates": geometry["coordinates"]}
+                  for geometry in geometries if geometry["type"] == "Polygon"]
+    outline = rasterize(boundaries, out_shape=shape, transform=transform, dtype=np.uint8).astype(bool)
+    return fill, outline | (fill & ~_erode(fill))
+
+
+def _erode(mask):
+    out = mask.copy()
+    out[1:, :] &= mask[:-1, :]
+    out[:-1, :] &= mask[1:, :]
+    out[:, 1:] &= mask[:, :-1]
+    out[:, :-1] &= mask[:, 1:]
+    return out
+
+
+def write_png(rgb, output_file):
+    """
+    Сохраняет массив [3, высота, ширина] uint8 в PNG (через временный файл).
+    """
+    tmp_file = output_file + ".tmp.png"
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(tmp_file, "w", driver="PNG", height=rgb.shape[1], width=rgb.shape[2],
+                           count=3, dtype="uint8") as dst:
+            dst.write(rgb)
+    os.replace(tmp_file, output_file)
+    aux_file = tmp_file + ".aux.xml"
+    if os.path.exists(aux_file):
+        os.remove(aux_file)
+
+
+def is_current(output_file, sources):
+    """
+    True, если output_file новее всех существующих исходных файлов.
+    """
+    if not os.path.exists(output_file):
+        return False
+    output_mtime = os.path.getmtime(output_file)
+    return all(os.path.getmtime(source) <= output_mtime for source in sources if os.path.exists(source))
+
+
+def render_tile_preview(bands_path, response_path, factor=8):
+    """
+    Рисует preview.png тайла: ложные цвета с контуром маски | разность NDVI | маска.
+    :param factor: Во сколько раз уменьшать тайл.
+    :return: Путь к превью.
+    """
+    tile_dir = os.path.dirname(response_path)
+    output_file = os.path.join(tile_dir, PREVIEW_FILENAME)
+    geojson_file = os.path.join(tile_dir, MASK_FILENAME)
+    if is_current(output_file, [bands_path, response_path, geojson_file]):
+        return output_file
+
+    (b03, b04, b08), transform = read_decimated(response_path, [1, 2, 3], factor)
+    shape = b03.shape
+    (b04_new, b08_new), _ = read_decimated(bands_path, [1, 2], factor, shape)
+
+    false_colour = np.stack([stretch(b08), stretch(b04), stretch(b03)])
+    fill, outline = mask_outline(geojson_file, shape, transform)
+    false_colour[:, outline] = np.array([255, 255, 0], dtype=np.uint8)[:, None]
+
+    delta_ndvi = (b08_new - b04_new) / (b08_new + b04_new + 1e-8) - (b08 - b04) / (b08 + b04 + 1e-8)
+    mask_panel = np.zeros((3,) + shape, dtype=np.uint8)
+    mask_panel[0, fill] = 255
+
+    separator = np.full((3, shape[0], 2), 255, dtype=np.uint8)
+    write_png(np.concatenate([false_colour, separator, diverging(delta_ndvi), separator, mask_panel], axis=2),
+              output_file)
+    return output_file
+
+
+def _render_tile(args):
+    bands_path, response_path, factor = args
+    try:
+        return render_tile_preview(bands_path, response_path, factor)
+    except Exception as e:
+        print(f"Ошибка превью {response_path}: {e}")
+        return None
+
+
+def render_granule_preview(granule_dir, tile_previews):
+    """
+    Собирает панели ложных цветов тайлов в мозаику гранулы по index_x/index_y из meta.json
+    (без meta.json тайлы раскладываются по сетке в порядке имён).
+    """
+    output_file = os.path.join(granule_dir, PREVIEW_FILENAME)
+    if not tile_previews or is_current(output_file, tile_previews):
+        return output_file
+
+    tiles = []
+    for number, preview in enumerate(sorted(tile_previews)):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", NotGeoreferencedWarning)
+            with rasterio.open(preview) as src:
+                image = src.read()
+        # Первая панель превью - ложные цвета с контуром
+        panel = image[:, :, :(image.shape[2] - 4) // 3]
+        meta_file = os.path.join(os.path.dirname(preview), "meta.json")
+        if os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+            position = (meta["index_x"], meta["index_y"])
+        else:
+            side = math.ceil(math.sqrt(len(tile_previews)))
+            position = (number % side, side - 1 - number // side)
+        tiles.append((position, panel))
+
+    tile_h = max(panel.shape[1] for _, panel in tiles)
+    tile_w = max(panel.shape[2] for _, panel in tiles)
+    max_x = max(x for (x, _), _ in tiles)
+    max_y = max(y for (_, y), _ in tiles)
+    mosaic = np.zeros((3, (max_y + 1) * tile_h, (max_x + 1) * tile_w), dtype=np.uint8)
+    for (x, y), panel in tiles:
+        # index_y у BBoxSplitter растёт на север, а строки изображения - на юг
+        row = (max_y - y) * tile_h
+        col = x * tile_w
+        mosaic[:, row:row + panel.shape[1], col:col + panel.shape[2]] = panel
+    write_png(mosaic, output_file)
+    return output_file
+
+
+def render_previews(path_2023, path_comparison, factor=8, workers=None):
+    """
+    Превью всех тайлов (в пуле процессов) и мозаики всех гранул.
+    :param workers: Число процессов (по умолчанию - по числу ядер).
+    :return: Число построенных превью тайлов.
+    """
+    jobs = [(bands_path, response_path, factor)
+            for _, _, bands_path, response_path in iter_granule_tiles(path_2023, path_comparison)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        previews = [preview for preview in executor.map(_render_tile, jobs, chunksize=4) if preview]
+
+    by_granule = {}
+    for preview in previews:
+        by_granule.setdefault(os.path.dirname(os.path.dirname(preview)), []).append(preview)
+    for granule_dir, tile_previews in by_granule.items():
+        print(f"Превью гранулы: {render_granule_preview(granule_dir, tile_previews)}")
+    return len(previews)
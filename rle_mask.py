@@ -0,0 +1,175 @@
+"""
+Бинарные маски тайлов в виде серий (run-length encoding) по развёрнутому построчно растру:
+маска - это словарь {'shape', 'transform', 'crs', 'starts', 'ends'}, где [starts[i], ends[i]) -
+отсортированные непересекающиеся интервалы линейных индексов пикселей со значением 1.
+Площадь, объединение, пересечение и перекрытие считаются прямо по сериям, без растров.
+"""
+import os
+import json
+import uuid
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from index_cache import pixel_area_m2
+
+
+RLE_FILENAME = "mask.rle.npz"
+
+
+def encode(mask, transform=None, crs=None):
+    """
+    Кодирует 2D бинарную маску в серии.
+    :param transform: Геопривязка маски (нужна для площади в м² и для GeoJSON).
+    :param crs: CRS маски (по умолчанию WGS84, как у тайлов).
+    """
+    flat = np.asarray(mask, dtype=bool).ravel()
+    edges = np.diff(np.concatenate(([0], flat.view(np.int8), [0])))
+    return {
+        "shape": tuple(int(n) for n in np.shape(mask)),
+        "transform": transform,
+        "crs": crs,
+        "starts": np.flatnonzero(edges == 1),
+        "ends": np.flatnonzero(edges == -1),
+    }
+
+
+def decode(rle):
+    """
+    Восстанавливает 2D bool-массив маски.
+    """
+    size = rle["shape"][0] * rle["shape"][1]
+    marks = np.zeros(size + 1, dtype=np.int8)
+    marks[rle["starts"]] += 1
+    marks[rle["ends"]] -= 1
+    return np.cumsum(marks[:-1]).astype(bool).reshape(rle["shape"])
+
+
+def encode_band(tiff_path, band, value=1):
+    """
+    Маска пикселей канала band (нумерация rasterio, с 1), равных value - например, CLM (4-й канал response.tiff).
+    """
+    with rasterio.open(tiff_path) as src:
+        return encode(src.read(band) == value, src.transform, src.crs)
+
+
+def area(rle, unit="pixels"):
+    """
+    Площадь маски: в пикселях, "m2" или "ha" (по геопривязке).
+    """
+    pixels = int(np.sum(rle["ends"] - rle["starts"]))
+    if unit == "pixels":
+        return pixels
+    m2 = pixels * pixel_area_m2(rle["transform"], rle["shape"][0], rle["crs"])
+    return m2 / 10000 if unit == "ha" else m2
+
+
+def _combine(a, b, weight_b, keep):
+    """
+    Сливает серии двух масок одного тайла: покрытие считается как сумма +1 от серий a и
+    +weight_b от серий b по отсортированным границам, keep(покрытие) выбирает нужные участки.
+    """
+    if a["shape"] != b["shape"]:
+        raise ValueError(f"Маски разного размера: {a['shape']} и {b['shape']}")
+    positions = np.concatenate((a["starts"], a["ends"], b["starts"], b["ends"]))
+    deltas = np.concatenate((np.ones(len(a["starts"]), dtype=np.int64), -np.ones(len(a["ends"]), dtype=np.int64),
+                             np.full(len(b["starts"]), weight_b), np.full(len(b["ends"]), -weight_b)))
+    order = np.argsort(positions, kind="stable")
+    positions, deltas = positions[order], deltas[order]
+    bounds, first = np.unique(positions, return_index=True)
+    # Покрытие на полуинтервале [bounds[i], bounds[i + 1])
+    coverage = np.cumsum(np.add.reduceat(deltas, first)) if len(bounds) else deltas
+    inside = np.concatenate(([0], keep(coverage).view(np.int8)))
+    changes = np.diff(inside)
+    return {
+        "shape": a["shape"],
+        "transform": a["transform"],
+        "crs": a["crs"],
+        "starts": bounds[changes == 1],
+        "ends": bounds[changes == -1],
+    }
+
+
+def union(a, b):
+    return _combine(a, b, 1, lambda coverage: coverage >= 1)
+
+
+def intersection(a, b):
+    return _combine(a, b, 1, lambda coverage: coverage == 2)
+
+
+def difference(a, b):
+    """
+    Пиксели a, которых нет в b (например, изменения, не закрытые облаком).
+    """
+    return _combine(a, b, 2, lambda coverage: coverage == 1)
+
+
+def overlap(a, b):
+    """
+    Сравнение двух масок одного тайла (разные пороги, даты или прогоны).
+    :return: Словарь с площадями в пикселях, IoU и долями взаимного покрытия.
+    """
+    area_a, area_b = area(a), area(b)
+    common = area(intersection(a, b))
+    total = area_a + area_b - common
+    return {
+        "area_a": area_a,
+        "area_b": area_b,
+        "intersection": common,
+        "union": total,
+        "iou": common / total if total else None,
+        "a_in_b": common / area_a if area_a else None,
+        "b_in_a": common / area_b if area_b else None,
+    }
+
+
+def save_rle(rle, output_file):
+    """
+    Сохраняет серии в .npz (индексы в наименьшем подходящем беззнаковом типе).
+    """
+    size = rle["shape"][0] * rle["shape"][1]
+    dtype = np.uint32 if size < 2 ** 32 else np.uint64
+    transform = list(rle["transform"])[:6] if rle["transform"] is not None else []
+    crs = rle["crs"].to_wkt() if rle["crs"] is not None else ""
+    tmp_file = f"{output_file}.{uuid.uuid4().hex}.tmp.npz"
+    np.savez_compressed(tmp_file, starts=rle["starts"].astype(dtype), ends=rle["ends"].astype(dtype),
+                        shape=np.array(rle["shape"]), transform=np.array(transform, dtype=np.float64),
+                        crs=np.array(crs))
+    os.replace(tmp_file, output_file)
+
+
+def load_rle(input_file):
+    with np.load(input_file) as data:
+        transform = Affine(*data["transform"]) if len(data["transform"]) else None
+        crs = CRS.from_wkt(str(data["crs"])) if str(data["crs"]) else None
+        return {
+            "shape": tuple(int(n) for n in data["shape"]),
+            "transform": transform,
+            "crs": crs,
+            "starts": data["starts"].astype(np.int64),
+            "ends": data["ends"].astype(np.int64),
+        }
+
+
+def to_geojson(rle, output_file, **vectorize_options):
+    """
+    Векторизует маску в GeoJSON (см. vectorize.save_mask_to_geojson).
+    :return: Число полигонов.
+    """
+    from vectorize import save_mask_to_geojson
+
+    return save_mask_to_geojson(decode(rle), rle["transform"], output_file, **vectorize_options)
+
+
+def from_geojson(geojson_file, shape, transform, crs=None):
+    """
+    Растеризует полигоны GeoJSON (например, mask.geojson) на сетку тайла и кодирует в серии.
+    """
+    with open(geojson_file, "r") as f:
+        features = json.load(f)["features"]
+    geometries = [feature["geometry"] for feature in features]
+    mask = rasterize(geometries, out_shape=shape, transform=transform, dtype=np.uint8) if geometries \
+        else np.zeros(shape, dtype=np.uint8)
+    return encode(mask, transform, crs)
@@ -0,0 +1,335 @@
+import os
+import json
+import time
+import atexit
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from sentinelhub import (
+    SHConfig, SHConstants, SentinelHubCatalog, SentinelHubDownloadClient, SentinelHubSession,
+    SentinelHubStatistical
+)
+from sentinelhub.download.sentinelhub_statistical_client import SentinelHubStatisticalDownloadClient
+
+
+# Размер пула keep-alive соединений - по числу потоков загрузки (cli.py --pool-size)
+POOL_SIZE = int(os.environ.get("SH_POOL_SIZE", "10"))
+
+_LOCK = threading.RLock()
+_CONFIGS = {}
+_SESSIONS = {}
+_CLIENTS = {}
+_http_session = None
+
+# Пул учётных записей Sentinel Hub: запросы распределяются между ними по остатку квоты.
+# Пустой пул - запросы идут от учётной записи из config самого запроса, как раньше.
+ACCOUNTS = []
+DEFAULT_RETRY_SECONDS = 30
+
+# Задержки успешных запросов по типам API: {тип: [число, сумма секунд]}.
+# Сохраняются в журнал SH_LATENCY_FILE и служат историей для оценок planner.py.
+LATENCIES = {}
+# Тип запроса по пути API - те же имена, что в planner.DEFAULT_LATENCIES
+LATENCY_KINDS = {"/api/v1/process": "process", "/api/v1/statistics": "statistics",
+                 "/api/v1/catalog/": "catalog"}
+
+
+def configure_pool(pool_size):
+    """
+    Задаёт размер пула соединений (вызывать до первых запросов, обычно = числу воркеров).
+    """
+    global POOL_SIZE, _http_session
+    with _LOCK:
+        POOL_SIZE = pool_size
+        _http_session = None
+        _CLIENTS.clear()
+
+
+def make_config(client_id, client_secret, instance_id):
+    """
+    Возвращает один и тот же SHConfig на набор учётных данных вместо нового объекта на каждый вызов.
+    """
+    key = (client_id, client_secret, instance_id)
+    with _LOCK:
+        if key not in _CONFIGS:
+            config = SHConfig()
+            config.sh_client_id = client_id
+            config.sh_client_secret = client_secret
+            config.instance_id = instance_id
+            _CONFIGS[key] = config
+        return _CONFIGS[key]
+
+
+def get_http_session():
+    """
+    Общая для процесса requests.Session с пулом keep-alive соединений:
+    TLS-рукопожатие выполняется один раз на соединение, а не на каждый запрос.
+    """
+    global _http_session
+    with _LOCK:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def get_sh_session(config):
+    """
+    Один OAuth-токен на клиента: SentinelHubSession сам обновляет его до истечения срока.
+    Сессия кэшируется и в SentinelHubDownloadClient, поэтому её подхватывают и каталог, и
+    запросы, созданные через request.get_data().
+    """
+    key = (config.sh_client_id, config.sh_base_url)
+    with _LOCK:
+        if key in _SESSIONS:
+            return _SESSIONS[key]
+    # Получение токена - сетевой вызов, поэтому вне _LOCK; если сессию параллельно создал
+    # другой поток, остаётся та, что попала в словарь первой
+    session = SentinelHubSession(config=config)
+    with _LOCK:
+        if key not in _SESSIONS:
+            SentinelHubDownloadClient.cache_session(session)
+            _SESSIONS[key] = session
+        return _SESSIONS[key]
+
+
+def add_account(client_id, client_secret, instance_id=None, quota_pu=None, name=None):
+    """
+    Добавляет учётную запись в пул.
+    :param quota_pu: Доступный остаток processing units (None - не ограничен).
+    """
+    with _LOCK:
+        ACCOUNTS.append({
+            "name": name or client_id[:8],
+            "config": make_config(client_id, client_secret, instance_id),
+            "quota_pu": quota_pu,
+            "used_pu": 0.0,
+            "requests": 0,
+            "in_flight": 0,
+            "cooldown_until": 0.0,
+            "exhausted": False,
+            "token_lock": threading.Lock(),
+        })
+
+
+def load_accounts(accounts_file):
+    """
+    Загружает пул из JSON-файла: список {"client_id", "client_secret", "instance_id", "quota_pu", "name"}.
+    """
+    with open(accounts_file, "r") as f:
+        for account in json.load(f):
+            add_account(account["client_id"], account["client_secret"], account.get("instance_id"),
+                        account.get("quota_pu"), account.get("name"))
+
+
+def account_status():
+    """
+    Снимок состояния пула для логов: имя, израсходованные PU, число запросов, пауза, исчерпание.
+    """
+    now = time.time()
+    with _LOCK:
+        return [{"name": a["name"], "used_pu": round(a["used_pu"], 2), "quota_pu": a["quota_pu"],
+                 "requests": a["requests"], "cooldown_s": round(max(a["cooldown_until"] - now, 0), 1),
+                 "exhausted": a["exhausted"]} for a in ACCOUNTS]
+
+
+def _headroom(account):
+    if account["quota_pu"] is None:
+        return float("inf")
+    return account["quota_pu"] - account["used_pu"]
+
+
+def _acquire_account(tried):
+    """
+    Выбирает учётную запись с наибольшим остатком квоты (при равенстве - наименее загруженную).
+    Если все доступные на паузе после 429, ждёт окончания ближайшей паузы.
+    :return: Учётная запись или None, если не осталось ни одной неисчерпанной и непробованной.
+    """
+    while True:
+        with _LOCK:
+            now = time.time()
+            candidates = [a for a in ACCOUNTS if not a["exhausted"] and a["name"] not in tried]
+            if not candidates:
+                return None
+            ready = [a for a in candidates if a["cooldown_until"] <= now]
+            if ready:
+                account = max(ready, key=lambda a: (_headroom(a), -a["in_flight"], -a["used_pu"]))
+                account["in_flight"] += 1
+                return account
+            wait = min(a["cooldown_until"] for a in candidates) - now
+        time.sleep(wait)
+
+
+def _release_account(account, response):
+    """
+    Учитывает ответ: израсходованные PU, паузу после 429 и исчерпание квоты.
+    """
+    with _LOCK:
+        account["in_flight"] -= 1
+        account["requests"] += 1
+        spent = response.headers.get("x-processingunits-spent")
+        if spent:
+            account["used_pu"] += float(spent)
+        if response.status_code == requests.codes.too_many_requests:
+            # Retry-After у Sentinel Hub - в миллисекундах
+            retry_ms = float(response.headers.get("Retry-After", DEFAULT_RETRY_SECONDS * 1000))
+            account["cooldown_until"] = time.time() + retry_ms / 1000
+        elif _is_quota_error(response) or _headroom(account) <= 0:
+            account["exhausted"] = True
+            print(f"Учётная запись {account['name']} исчерпала квоту, переключаемся на другие")
+
+
+def _is_quota_error(response):
+    if response.status_code not in (requests.codes.forbidden, requests.codes.payment_required):
+        return False
+    text = response.text.lower()
+    return "processing unit" in text or "quota" in text
+
+
+def _record_latency(url, seconds):
+    kind = next((kind for path, kind in LATENCY_KINDS.items() if path in url), None)
+    if kind is None:  # Прочие запросы (OAuth, конфигурация) в оценках не участвуют
+        return
+    with _LOCK:
+        stats = LATENCIES.setdefault(kind, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+
+def save_latency_log(log_file):
+    """
+    Добавляет накопленные задержки к журналу {тип: {"count": ..., "total_s": ...}} (через временный файл).
+    """
+    with _LOCK:
+        if not LATENCIES:
+            return
+        log = {}
+        if os.path.exists(log_file):
+            with open(log_file, "r") as f:
+                log = json.load(f)
+        for kind, (count, total) in LATENCIES.items():
+            entry = log.setdefault(kind, {"count": 0, "total_s": 0.0})
+            entry["count"] += count
+            entry["total_s"] = round(entry["total_s"] + total, 3)
+        LATENCIES.clear()
+        tmp_file = f"{log_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(log, f, indent=2)
+        os.replace(tmp_file, log_file)
+
+
+class _PooledClientMixin:
+    """
+    Отправляет запросы через общую HTTP-сессию и использует постоянный lock, чтобы один
+    экземпляр клиента можно было вызывать из нескольких потоков одновременно.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Свой lock у каждого клиента: под ним идут обновление токена и учёт rate limit, и общий
+        # _LOCK держал бы на время этих сетевых вызовов все клиенты и потоки процесса.
+        # Ставится сразу: get_json() (каталог) идёт мимо download() и тоже должен быть под ним
+        self._client_lock = threading.Lock()
+        self.lock = self._client_lock
+
+    def download(self, *args, **kwargs):
+        # Базовый download() создаёт и обнуляет self.lock на каждый вызов - для общего
+        # клиента это гонка, поэтому lock постоянный
+        self.lock = self._client_lock
+        return super(SentinelHubDownloadClient, self).download(*args, **kwargs)
+
+    def _send(self, request, headers):
+        started = time.perf_counter()
+        response = get_http_session().request(
+            request.request_type.value,
+            url=request.url,
+            json=request.post_values,
+            headers=headers,
+            timeout=self.config.download_timeout_seconds,
+        )
+        if response.ok:
+            _record_latency(request.url, time.perf_counter() - started)
+        return response
+
+    def _do_download(self, request):
+        if request.url is None:
+            raise ValueError(f"Faulty request {request}, no URL specified.")
+        if not ACCOUNTS or not request.use_session:
+            return self._send(request, self._prepare_headers(request))
+
+        # Запрос уходит от учётной записи с наибольшим остатком квоты; при 429 или исчерпании
+        # квоты сразу повторяется от следующей. Если перепробованы все, последний ответ 429
+        # возвращается базовому клиенту, который подождёт по его заголовкам.
+        tried = set()
+        response = None
+        while True:
+            account = _acquire_account(tried)
+            if account is None:
+                if response is None:
+                    return self._send(request, self._prepare_headers(request))
+                return response
+            try:
+                session = get_sh_session(account["config"])
+                with account["token_lock"]:  # Обновление токена - сетевой вызов, общий _LOCK не держим
+                    session_headers = session.session_headers
+                response = self._send(request, {**SHConstants.HEADERS, **session_headers, **request.headers})
+            except Exception:
+                with _LOCK:
+                    account["in_flight"] -= 1
+                raise
+            _release_account(account, response)
+            if response.status_code != requests.codes.too_many_requests and not _is_quota_error(response):
+                return response
+            tried.add(account["name"])
+
+
+class PooledDownloadClient(_PooledClientMixin, SentinelHubDownloadClient):
+    pass
+
+
+class PooledStatisticalDownloadClient(_PooledClientMixin, SentinelHubStatisticalDownloadClient):
+    pass
+
+
+def get_download_client(config, statistical=False):
+    """
+    Потокобезопасный общий клиент загрузки для данного SHConfig.
+    """
+    client_class = PooledStatisticalDownloadClient if statistical else PooledDownloadClient
+    key = (config.sh_client_id, config.sh_base_url, client_class)
+    with _LOCK:
+        if key in _CLIENTS:
+            return _CLIENTS[key]
+    session = get_sh_session(config)
+    with _LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = client_class(config=config, session=session)
+        return _CLIENTS[key]
+
+
+def get_catalog(config):
+    """
+    SentinelHubCatalog, который ходит через общий клиент: пул соединений, пул учётных записей
+    и учёт задержек ("catalog") - как и остальные запросы.
+    """
+    catalog = SentinelHubCatalog(config=config)
+    catalog.client = get_download_client(config)
+    return catalog
+
+
+if os.environ.get("SH_ACCOUNTS_FILE"):
+    load_accounts(os.environ["SH_ACCOUNTS_FILE"])
+if os.environ.get("SH_LATENCY_FILE"):
+    atexit.register(save_latency_log, os.environ["SH_LATENCY_FILE"])
+
+
+def get_data(sh_request, decode_data=True, max_threads=None):
+    """
+    Аналог sh_request.get_data(), но через общий клиент, пул соединений и кэшированный токен.
+    """
+    client = get_download_client(sh_request.config, statistical=isinstance(sh_request, SentinelHubStatistical))
+    return client.download(sh_request.download_list, max_threads=max_threads or POOL_SIZE,
+                           decode_data=decode_data)
@@ -2,11 +2,8 @@ import os
 import rasterio
 import numpy as np
 from datetime import datetime, timedelta
-from sentinelhub import (
-    SentinelHubCatalog, SentinelHubRequest, BBox, CRS, MimeType, DataCollection,
-    SHConfig, bbox_to_dimensions
-)
-from pathlib import Path
+from sentinelhub import SentinelHubRequest, BBox, CRS, MimeType, DataCollection
+import sh_session
 
 
 def download_clm_mask(bbox, time_interval, config, target_size):
@@ -36,7 +33,7 @@ def download_clm_mask(bbox, time_interval, config, target_size):
         size=target_size,
         config=config
     )
-    response = request.get_data()
+    response = sh_session.get_data(request)
     return np.array(response[0])  # Преобразование ответа в NumPy массив
 
 
@@ -73,7 +70,7 @@ def download_new_bands(bbox, time_interval, config, target_size, output_dir):
     print(f"Save path: {output_dir}")
 
     # Получаем данные
-    response = request.get_data()
+    response = sh_session.get_data(request)
     if not response:
         raise ValueError("Empty response received from SentinelHub")
 
@@ -113,11 +110,7 @@ def compare_masks(original_mask, candidate_mask, threshold=1.0):
 
 
 def make_config(ins_id):
-    config = SHConfig()
-    config.sh_client_id = '6ad7a64d-3006-4a1d-9a3e-caeccbce3c04'
-    config.sh_client_secret = 'mvOFmvLWFgCOERsxRo4GP1PnKnkH8EU6'
-    config.instance_id = ins_id
-    return config
+    return sh_session.make_config('6ad7a64d-3006-4a1d-9a3e-caeccbce3c04', 'mvOFmvLWFgCOERsxRo4GP1PnKnkH8EU6', ins_id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+import os
+import csv
+import numpy as np
+import rasterio
+from tile_stream import find_tiff_files_by_subfolder
+from index_cache import load_or_compute_indices, pixel_area_m2
+
+
+def sweep_counts(ndwi, delta_ndvi, ndwi_thresholds, diff_thresholds):
+    """
+    За один проход по пикселям считает число пикселей (ndwi < T1) & (delta_ndvi > T2)
+    для всех пар порогов сетки.
+    :param ndwi: Растр NDWI.
+    :param delta_ndvi: Растр first_ndvi - second_ndvi.
+    :param ndwi_thresholds: Возрастающий массив порогов T1.
+    :param diff_thresholds: Возрастающий массив порогов T2.
+    :return: Массив counts[len(T1), len(T2)].
+    """
+    t1 = np.asarray(ndwi_thresholds)
+    t2 = np.asarray(diff_thresholds)
+    valid = ~(np.isnan(ndwi) | np.isnan(delta_ndvi))
+    # ndwi < t1[j] <=> j >= i;  delta > t2[m] <=> m < k
+    i = np.searchsorted(t1, ndwi[valid], side='right')
+    k = np.searchsorted(t2, delta_ndvi[valid], side='left')
+    hist = np.bincount(i * (len(t2) + 1) + k, minlength=(len(t1) + 1) * (len(t2) + 1))
+    hist = hist.reshape(len(t1) + 1, len(t2) + 1)
+
+    below_t1 = np.cumsum(hist, axis=0)[:len(t1)]
+    above_t2 = np.cumsum(below_t1[:, ::-1], axis=1)[:, ::-1]
+    return above_t2[:, 1:]
+
+
+def sweep_granules(path_2023, path_comparison, ndwi_thresholds, diff_thresholds):
+    """
+    Проходит по всем тайлам всех гранул один раз.
+    :return: (строки по тайлам, строки по гранулам) для записи в CSV.
+    """
+    tile_rows = []
+    granule_rows = []
+    for folder in sorted(os.listdir(path_2023)):
+        path_to_folder_2023 = os.path.join(path_2023, folder)
+        path_to_orig_folder = os.path.join(path_comparison, folder)
+        if not os.path.isdir(path_to_folder_2023) or not os.path.isdir(path_to_orig_folder):
+            continue
+
+        bands_dict = find_tiff_files_by_subfolder(path_to_folder_2023, "bands.tiff")
+        response_dict = find_tiff_files_by_subfolder(path_to_orig_folder, "response.tiff")
+        granule_pixels = np.zeros((len(ndwi_thresholds), len(diff_thresholds)), dtype=np.int64)
+        granule_area = np.zeros((len(ndwi_thresholds), len(diff_thresholds)))
+
+        for subfolder in sorted(set(bands_dict) & set(response_dict)):
+            try:
+                indices = load_or_compute_indices(bands_dict[subfolder], response_dict[subfolder])
+                with rasterio.open(response_dict[subfolder]) as src:
+                    area = pixel_area_m2(src.transform, src.height, src.crs)
+            except Exception as e:
+                print(f"Ошибка загрузки файлов в {subfolder}: {e}")
+                continue
+
+            counts = sweep_counts(indices["ndwi"], indices["first_ndvi"] - indices["second_ndvi"],
+                                  ndwi_thresholds, diff_thresholds)
+            granule_pixels += counts
+            granule_area += counts * area
+            for j, t1 in enumerate(ndwi_thresholds):
+                for m, t2 in enumerate(diff_thresholds):
+                    tile_rows.append([folder, subfolder, float(t1), float(t2),
+                                      int(counts[j, m]), float(counts[j, m] * area / 10000)])
+
+        for j, t1 in enumerate(ndwi_thresholds):
+            for m, t2 in enumerate(diff_thresholds):
+                granule_rows.append([folder, float(t1), float(t2),
+                                     int(granule_pixels[j, m]), float(granule_area[j, m] / 10000)])
+    return tile_rows, granule_rows
+
+
+def write_csv(rows, header, output_file):
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    print(f"Таблица сохранена в {output_file}")
+
+
+if __name__ == "__main__":
+    path_2023 = r"D:\omela\new_band_data"
+    path_comparison = r"D:\omela\output_data_sentinel"
+    output_dir = r"D:\omela\threshold_sweep"
+
+    # Сетка 20x20 порогов считается за один проход по данным
+    ndwi_thresholds = np.round(np.linspace(-0.3, 0.4, 20), 4)
+    diff_thresholds = np.round(np.linspace(0.05, 0.5, 20), 4)
+
+    tile_rows, granule_rows = sweep_granules(path_2023, path_comparison, ndwi_thresholds, diff_thresholds)
+    write_csv(tile_rows, ["granule", "tile", "ndwi_threshold", "diff_threshold", "pixels", "area_ha"],
+              os.path.join(output_dir, "sweep_tiles.csv"))
+    write_csv(granule_rows, ["granule", "ndwi_threshold", "diff_threshold", "pixels", "area_ha"],
+              os.path.join(output_dir, "sweep_granules.csv"))
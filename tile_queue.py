@@ -0,0 +1,256 @@
+import os
+import json
+import hashlib
+import time
+import socket
+import sqlite3
+import threading
+
+
+# Задание, аренда которого истекла (воркер упал или завис), снова становится доступным
+LEASE_SECONDS = 300
+HEARTBEAT_SECONDS = 60
+MAX_ATTEMPTS = 3
+
+
+def connect(db_path):
+    """
+    Соединение с общей очередью. Файл SQLite может лежать на общей для узлов файловой системе.
+    """
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated REAL
+        )
+    """)
+    return conn
+
+
+def enqueue(conn, kind, job_id, payload):
+    """
+    Добавляет задание; повторное добавление того же id игнорируется.
+    :return: True, если задание новое.
+    """
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO jobs (id, kind, payload, updated) VALUES (?, ?, ?, ?)",
+        (job_id, kind, json.dumps(payload), time.time())
+    )
+    return cursor.rowcount == 1
+
+
+def make_job_id(kind, name, payload):
+    """
+    Id задания из всего payload: то же задание с другими параметрами - новое задание.
+    """
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{kind}:{name}:{digest}"
+
+
+def lease(conn, worker_id, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """
+    Атомарно берёт в аренду одно задание: свободное или с истёкшей арендой.
+    :return: Словарь {'id', 'kind', 'payload', 'attempts'} или None, если заданий нет.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'lease expired', updated = ? "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, now, max_attempts)
+        )
+        row = conn.execute(
+            """SELECT id, kind, payload, attempts FROM jobs
+               WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ?
+               ORDER BY rowid LIMIT 1""",
+            (now, max_attempts)
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? "
+            "WHERE id = ?",
+            (worker_id, now + lease_seconds, now, row["id"])
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return {"id": row["id"], "kind": row["kind"], "payload": json.loads(row["payload"]),
+            "attempts": row["attempts"] + 1}
+
+
+def heartbeat(conn, job_id, worker_id, lease_seconds=LEASE_SECONDS):
+    """
+    Продлевает аренду. False - аренда потеряна (истекла и задание забрал другой воркер).
+    """
+    cursor = conn.execute(
+        "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND owner = ? AND status = 'leased'",
+        (time.time() + lease_seconds, time.time(), job_id, worker_id)
+    )
+    return cursor.rowcount == 1
+
+
+def complete(conn, job_id, worker_id):
+    conn.execute(
+        "UPDATE jobs SET status = 'done', lease_expires = NULL, error = NULL, updated = ? "
+        "WHERE id = ? AND owner = ?",
+        (time.time(), job_id, worker_id)
+    )
+
+
+def fail(conn, job_id, worker_id, error, max_attempts=MAX_ATTEMPTS):
+    """
+    Возвращает задание в очередь, пока не исчерпаны попытки, иначе помечает failed.
+    """
+    conn.execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "lease_expires = NULL, error = ?, updated = ? WHERE id = ? AND owner = ?",
+        (max_attempts, str(error), time.time(), job_id, worker_id)
+    )
+
+
+def queue_status(conn):
+    """
+    Число заданий по (kind, status).
+    """
+    rows = conn.execute("SELECT kind, status, COUNT(*) AS n FROM jobs GROUP BY kind, status ORDER BY kind, status")
+    return [(row["kind"], row["status"], row["n"]) for row in rows]
+
+
+def run_find_dates_job(payload):
+    """
+    Поиск дат для гранулы и загрузка бэндов. dates.json пишется атомарно и при повторе с теми же
+    параметрами поиска не пересчитывается; bands.tiff скачивается заново, только если его нет
+    или он получен на другую дату/окно.
+    """
+    from datetime import datetime
+    from clear_dates import (DATES_FILENAME, make_config, search_params, read_dates, write_dates,
+                             find_granule_dates, invalidate_bands, bands_to_download, download_granule_bands)
+
+    config = make_config(payload["instance_id"])
+    output_dir = payload["output_dir"]
+    dates_file = os.path.join(output_dir, DATES_FILENAME)
+    search = search_params(payload["start_date"], payload["end_date"], payload["mode"],
+                           payload["max_candidates"], payload["threshold"])
+    found, previous = read_dates(dates_file) if os.path.exists(dates_file) else (None, None)
+    if previous != search:
+        found = find_granule_dates(payload["input_path"], config,
+                                   datetime.strptime(payload["start_date"], "%Y-%m-%d"),
+                                   datetime.strptime(payload["end_date"], "%Y-%m-%d"),
+                                   payload["mode"], payload["max_candidates"], payload["threshold"])
+        os.makedirs(output_dir, exist_ok=True)
+        # Бэнды прошлого поиска не должны остаться рядом с новым dates.json
+        invalidate_bands(found, output_dir)
+        write_dates(dates_file, found, search)
+
+    download_granule_bands(bands_to_download(found, output_dir), output_dir, config)
+
+
+def run_mask_job(payload):
+    from mask_stage import process_tile
+
+    result = process_tile(payload["bands_path"], payload["response_path"], payload["ndwi_threshold"],
+                          payload["diff_threshold"], payload["vectorize_options"], payload.get("stats_db"))
+    if result is None:
+        raise RuntimeError(f"Не удалось построить маску для {payload['response_path']}")
+
+
+JOB_HANDLERS = {
+    "find-dates": run_find_dates_job,
+    "mask": run_mask_job,
+}
+
+
+def enqueue_find_dates(conn, input_dir, output_dir, start_date, end_date, mode="hierarchical",
+                       max_candidates=5, threshold=1.0, instance_id=None):
+    """
+    Ставит в очередь по заданию поиска дат на каждую гранулу из input_dir.
+    """
+    added = 0
+    for folder in sorted(os.listdir(input_dir)):
+        input_path = os.path.join(input_dir, folder)
+        if not os.path.isdir(input_path):
+            continue
+        payload = {"input_path": os.path.abspath(input_path),
+                   "output_dir": os.path.abspath(os.path.join(output_dir, folder)),
+                   "start_date": start_date, "end_date": end_date, "mode": mode,
+                   "max_candidates": max_candidates, "threshold": threshold, "instance_id": instance_id}
+        added += enqueue(conn, "find-dates", make_job_id("find-dates", payload["input_path"], payload), payload)
+    return added
+
+
+def enqueue_masks(conn, path_2023, path_comparison, ndwi_threshold, diff_threshold, vectorize_options=None,
+                  stats_db=None):
+    """
+    Ставит в очередь по заданию построения маски на каждый тайл.
+    """
+    from mask_stage import iter_granule_tiles
+
+    added = 0
+    for folder, subfolder, bands_path, response_path in iter_granule_tiles(path_2023, path_comparison):
+        payload = {"bands_path": os.path.abspath(bands_path), "response_path": os.path.abspath(response_path),
+                   "ndwi_threshold": ndwi_threshold, "diff_threshold": diff_threshold,
+                   "vectorize_options": vectorize_options or {},
+                   "stats_db": os.path.abspath(stats_db) if stats_db else None}
+        added += enqueue(conn, "mask", make_job_id("mask", payload["response_path"], payload), payload)
+    return added
+
+
+def run_worker(db_path, worker_id=None, lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS,
+               poll_seconds=10, exit_when_empty=True, handlers=None):
+    """
+    Цикл воркера: берёт задание в аренду, продлевает её из фонового потока, пока задание выполняется,
+    и отмечает результат. Несколько воркеров на разных машинах работают с одним файлом очереди.
+    :return: Число выполненных заданий.
+    """
+    handlers = handlers or JOB_HANDLERS
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    conn = connect(db_path)
+    done_count = 0
+
+    while True:
+        job = lease(conn, worker_id, lease_seconds)
+        if job is None:
+            if exit_when_empty:
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        print(f"[{worker_id}] {job['kind']} {job['id']} (попытка {job['attempts']})")
+        stop = threading.Event()
+
+        def keep_alive(job_id=job["id"]):
+            hb_conn = connect(db_path)
+            while not stop.wait(heartbeat_seconds):
+                if not heartbeat(hb_conn, job_id, worker_id, lease_seconds):
+                    print(f"[{worker_id}] Аренда {job_id} потеряна")
+                    break
+            hb_conn.close()
+
+        hb_thread = threading.Thread(target=keep_alive, daemon=True)
+        hb_thread.start()
+        try:
+            handlers[job["kind"]](job["payload"])
+        except Exception as e:
+            print(f"[{worker_id}] Ошибка в {job['id']}: {e}")
+            fail(conn, job["id"], worker_id, e)
+        else:
+            complete(conn, job["id"], worker_id)
+            done_count += 1
+        finally:
+            stop.set()
+            hb_thread.join()
+
+    conn.close()
+    return done_count
@@ -0,0 +1,104 @@
+import os
+import time
+import sqlite3
+import numpy as np
+
+
+def connect_stats(db_path):
+    """
+    Таблица сводной статистики по тайлам и представление с агрегатами по гранулам.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tile_stats (
+            granule TEXT NOT NULL,
+            tile TEXT NOT NULL,
+            flagged_pixels INTEGER,
+            flagged_area_ha REAL,
+            polygon_count INTEGER,
+            mean_delta_ndvi REAL,
+            ndwi_masked_fraction REAL,
+            cloud_fraction REAL,
+            comparison_date TEXT,
+            ndwi_threshold REAL,
+            diff_threshold REAL,
+            processing_seconds REAL,
+            updated REAL,
+            PRIMARY KEY (granule, tile)
+        )
+    """)
+    conn.execute("""
+        CREATE VIEW IF NOT EXISTS granule_stats AS
+        SELECT granule,
+               COUNT(*) AS tiles,
+               SUM(flagged_pixels) AS flagged_pixels,
+               SUM(flagged_area_ha) AS flagged_area_ha,
+               SUM(polygon_count) AS polygon_count,
+               AVG(cloud_fraction) AS mean_cloud_fraction,
+               SUM(processing_seconds) AS processing_seconds
+        FROM tile_stats GROUP BY granule
+    """)
+    return conn
+
+
+def comparison_date(bands_path):
+    """
+    Дата снимка 2023 года для тайла из dates.json гранулы (если тайл скачивался через find-dates).
+    """
+    from clear_dates import DATES_FILENAME, read_dates
+
+    tile_dir = os.path.dirname(bands_path)
+    dates_file = os.path.join(os.path.dirname(tile_dir), DATES_FILENAME)
+    if not os.path.exists(dates_file):
+        return None
+    entry = read_dates(dates_file)[0].get(os.path.basename(tile_dir))
+    return entry["date"] if entry else None
+
+
+def tile_summary(mask, indices, clm, pixel_area, polygon_count, ndwi_threshold):
+    """
+    Сводные показатели одного тайла по уже посчитанным в проходе маски массивам.
+    :param mask: Очищенная маска изменений - та, что векторизуется в mask.geojson.
+    :param indices: Словарь индексов (index_cache.load_or_compute_indices).
+    :param clm: 4-й канал response.tiff (CLM) или None.
+    :param pixel_area: Площадь пикселя в м².
+    """
+    delta_ndvi = indices["first_ndvi"] - indices["second_ndvi"]
+    ndwi = indices["ndwi"]
+    flagged = int(np.count_nonzero(mask))
+    clm_valid = clm[~np.isnan(clm)] if clm is not None else np.empty(0)
+    return {
+        "flagged_pixels": flagged,
+        "flagged_area_ha": flagged * pixel_area / 10000,
+        "polygon_count": polygon_count,
+        "mean_delta_ndvi": float(np.nanmean(delta_ndvi[mask])) if flagged else None,
+        "ndwi_masked_fraction": float(np.count_nonzero(ndwi >= ndwi_threshold) / ndwi.size),
+        "cloud_fraction": float(np.mean(clm_valid == 1)) if clm_valid.size else None,
+    }
+
+
+def has_tile_stats(db_path, granule, tile, ndwi_threshold, diff_threshold):
+    """
+    True, если для тайла уже есть строка с теми же порогами.
+    """
+    conn = connect_stats(db_path)
+    row = conn.execute(
+        "SELECT 1 FROM tile_stats WHERE granule = ? AND tile = ? AND ndwi_threshold = ? AND diff_threshold = ?",
+        (granule, tile, ndwi_threshold, diff_threshold)
+    ).fetchone()
+    conn.close()
+    return row is not None
+
+
+def write_tile_stats(db_path, granule, tile, summary, comparison_date, ndwi_threshold, diff_threshold,
+                     processing_seconds):
+    conn = connect_stats(db_path)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO tile_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (granule, tile, summary["flagged_pixels"], summary["flagged_area_ha"], summary["polygon_count"],
+             summary["mean_delta_ndvi"], summary["ndwi_masked_fraction"], summary["cloud_fraction"],
+             comparison_date, ndwi_threshold, diff_threshold, processing_seconds, time.time())
+        )
+    conn.close()
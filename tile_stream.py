@@ -0,0 +1,80 @@
+import os
+import queue
+import threading
+import band_cache
+
+
+def find_tiff_files_by_subfolder(directory, target_filename):
+    """
+    Ищет файлы с заданным именем в подпапках directory и возвращает словарь:
+    ключ - относительный путь подпапки относительно directory,
+    значение - путь к файлу.
+    """
+    file_dict = {}
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if file == target_filename:
+                rel_path = os.path.relpath(root, directory)
+                file_dict[rel_path] = os.path.join(root, file)
+    return file_dict
+
+
+def read_tiff(file_path):
+    """
+    Читает все каналы одного .tiff файла.
+    :return: (список 2D массивов по каналам, transform)
+    """
+    bands, transform = band_cache.read_bands(file_path)
+    return list(bands), transform
+
+
+def iter_tile_pairs(path_2023, path_comparison, prefetch=2):
+    """
+    Генератор сопоставленных по подпапке пар тайлов (bands.tiff 2023 и response.tiff 2018).
+    Следующие тайлы декодируются в фоновом потоке, пока вызывающий код обрабатывает текущий;
+    в памяти одновременно не больше prefetch + 1 тайла.
+    :param path_2023: Папка гранулы с bands.tiff.
+    :param path_comparison: Папка гранулы с response.tiff.
+    :param prefetch: Глубина очереди упреждающего чтения.
+    :return: Кортежи (подпапка, каналы 2023, каналы сравнения, transform response.tiff, путь к response.tiff).
+    """
+    bands_dict = find_tiff_files_by_subfolder(path_2023, "bands.tiff")
+    response_dict = find_tiff_files_by_subfolder(path_comparison, "response.tiff")
+    subfolders = sorted(set(bands_dict) & set(response_dict))
+
+    tile_queue = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                tile_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        for subfolder in subfolders:
+            try:
+                bands_2023, _ = read_tiff(bands_dict[subfolder])
+                bands_comp, transform = read_tiff(response_dict[subfolder])
+            except Exception as e:
+                print(f"Ошибка загрузки файлов в {subfolder}: {e}")
+                continue
+            if not put((subfolder, bands_2023, bands_comp, transform, response_dict[subfolder])):
+                return
+        put(done)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = tile_queue.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,226 @@
+import os
+import math
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from affine import Affine
+from rasterio.features import shapes, sieve
+from shapely import normalize
+from shapely.affinity import affine_transform
+from shapely.geometry import Polygon, shape, mapping
+from shapely.ops import unary_union
+import geojson
+from index_cache import pixel_area_m2
+
+
+# Векторизация по блокам в пуле процессов (число процессов можно задать через POLYGONIZE_WORKERS)
+POLYGONIZE_WORKERS = int(os.environ.get("POLYGONIZE_WORKERS", "1"))
+BLOCK_SIZE = 2048
+
+
+def configure(workers, block_size=None):
+    global POLYGONIZE_WORKERS, BLOCK_SIZE
+    POLYGONIZE_WORKERS = workers
+    if block_size is not None:
+        BLOCK_SIZE = block_size
+
+
+def binary_closing(mask, iterations=1):
+    """
+    Морфологическое закрытие (дилатация, затем эрозия) 4-связным крестом: заполняет
+    узкие разрывы и щели в маске шириной до 2 * iterations пикселей.
+    """
+    mask = mask.astype(bool)
+    if iterations <= 0:
+        return mask
+
+    def dilate(m):
+        out = m.copy()
+        out[1:, :] |= m[:-1, :]
+        out[:-1, :] |= m[1:, :]
+        out[:, 1:] |= m[:, :-1]
+        out[:, :-1] |= m[:, 1:]
+        return out
+
+    padded = np.pad(mask, iterations, mode='constant')
+    for _ in range(iterations):
+        padded = dilate(padded)
+    for _ in range(iterations):
+        padded = ~dilate(~padded)
+    return padded[iterations:-iterations, iterations:-iterations]
+
+
+def clean_mask(mask, min_pixels=0, closing_iterations=0):
+    """
+    Подготовка маски перед векторизацией.
+    :param mask: Бинарная маска (2D массив).
+    :param min_pixels: Минимальная картографируемая единица: связные области (и дыры) меньше
+        этого числа пикселей поглощаются соседями через rasterio.features.sieve.
+    :param closing_iterations: Число итераций морфологического закрытия (0 - отключено).
+    :return: Маска uint8 из 0 и 1.
+    """
+    mask = mask.astype(bool)
+    if closing_iterations > 0:
+        mask = binary_closing(mask, closing_iterations)
+    mask = mask.astype(np.uint8)
+    if min_pixels > 1:
+        mask = sieve(mask, size=min_pixels, connectivity=4)
+    return mask
+
+
+def _polygonize_block(block, row_off, col_off):
+    """
+    Векторизует один блок маски в пиксельных координатах всей маски.
+    :return: Список пар (полигон, отрезки внешнего кольца на краях блока). Отрезок -
+        ((ориентация, координата линии), начало, конец) в целых пикселях.
+    """
+    height, width = block.shape
+    rows = (row_off, row_off + height)
+    cols = (col_off, col_off + width)
+    result = []
+    for geom, value in shapes(block, transform=Affine.translation(col_off, row_off)):
+        if value != 1:
+            continue
+        polygon = shape(geom)
+        coords = geom["coordinates"][0]
+        edges = []
+        for (x0, y0), (x1, y1) in zip(coords[:-1], coords[1:]):
+            if y0 == y1 and y0 in rows:
+                edges.append((("h", int(y0)), int(min(x0, x1)), int(max(x0, x1))))
+            elif x0 == x1 and x0 in cols:
+                edges.append((("v", int(x0)), int(min(y0, y1)), int(max(y0, y1))))
+        result.append((polygon, edges))
+    return result
+
+
+def _scan_order(polygon):
+    # Первый пиксель полигона при построчном обходе: верхняя строка, левый столбец
+    miny = polygon.bounds[1]
+    return miny, min(x for x, y in polygon.exterior.coords if y == miny)
+
+
+def canonical_polygons(polygons):
+    """
+    Приводит полигоны в пиксельных координатах к каноническому виду: кольца через
+    shapely.normalize, порядок - построчный обход. Последовательная и блочная векторизация
+    дают после этого одинаковые координаты (и одинаковый результат simplify).
+    """
+    return sorted((normalize(polygon) for polygon in polygons), key=_scan_order)
+
+
+def polygonize_blocks(mask, workers, block_size=None):
+    """
+    Параллельный аналог shapes(): маска режется на блоки block_size x block_size, блоки
+    векторизуются в пуле процессов, а полигоны, разрезанные швами блоков, склеиваются.
+    Полигоны соседних блоков объединяются (union-find + unary_union), если их внешние
+    контуры имеют общий отрезок на шве - это та же 4-связность, что и у shapes();
+    касание углом не склеивает.
+    :param block_size: Сторона блока в пикселях (по умолчанию BLOCK_SIZE на момент вызова, см. configure).
+    :return: Полигоны в пиксельных координатах (canonical_polygons).
+    """
+    block_size = block_size or BLOCK_SIZE
+    mask = mask.astype(np.uint8)
+    height, width = mask.shape
+    offsets = [(r, c) for r in range(0, height, block_size) for c in range(0, width, block_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_polygonize_block, mask[r:r + block_size, c:c + block_size], r, c)
+                   for r, c in offsets]
+        blocks = [future.result() for future in futures]
+
+    polygons = []
+    edge = []
+    lines = {}
+    for polygon, edges in (item for block in blocks for item in block):
+        if not edges:
+            polygons.append(polygon)
+            continue
+        for line, start, end in edges:
+            lines.setdefault(line, []).append((start, end, len(edge)))
+        edge.append(polygon)
+
+    parent = list(range(len(edge)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Отрезки одного блока на линии не пересекаются, поэтому перекрытие отрезков
+    # положительной длины - это общая граница полигонов из соседних блоков
+    for segments in lines.values():
+        segments.sort()
+        reach, owner = None, None
+        for start, end, i in segments:
+            if reach is not None and start < reach:
+                parent[find(i)] = find(owner)
+            if reach is None or end > reach:
+                reach, owner = end, i
+
+    groups = {}
+    for i in range(len(edge)):
+        groups.setdefault(find(i), []).append(edge[i])
+    for group in groups.values():
+        if len(group) == 1:
+            polygons.append(group[0])
+            continue
+        # Дыры кусков не касаются краёв блоков, поэтому объединяются только внешние контуры,
+        # а дыры переносятся как есть; simplify(0) убирает вершины, оставшиеся на линиях швов
+        merged = unary_union([Polygon(polygon.exterior) for polygon in group]).simplify(0)
+        holes = [hole for polygon in group for hole in polygon.interiors]
+        polygons.append(Polygon(merged.exterior, list(merged.interiors) + holes))
+
+    return canonical_polygons(polygons)
+
+
+def mask_to_polygons(mask, transform, simplify_m=0, crs=None, workers=None):
+    """
+    Векторизует маску и, при необходимости, упрощает полигоны с сохранением топологии.
+    :param simplify_m: Допуск упрощения в метрах (0 - без упрощения).
+    :param workers: Число процессов для блочной векторизации (по умолчанию POLYGONIZE_WORKERS);
+        маски меньше двух блоков векторизуются в одном процессе.
+    :return: Список shapely-полигонов со значением 1.
+    """
+    workers = POLYGONIZE_WORKERS if workers is None else workers
+    if workers > 1 and max(mask.shape) >= 2 * BLOCK_SIZE:
+        polygons = polygonize_blocks(mask, workers, BLOCK_SIZE)
+    else:
+        polygons = canonical_polygons(shape(geom) for geom, value in shapes(mask.astype(np.uint8)) if value == 1)
+    # Векторизация идёт в пиксельных координатах, геопривязка применяется в конце
+    matrix = [transform.a, transform.b, transform.d, transform.e, transform.c, transform.f]
+    polygons = [affine_transform(polygon, matrix) for polygon in polygons]
+    if simplify_m > 0 and polygons:
+        # Допуск переводится в единицы CRS (для WGS84 - градусы) по размеру пикселя
+        metres_per_unit = math.sqrt(pixel_area_m2(transform, mask.shape[0], crs) / abs(transform.a * transform.e))
+        tolerance = simplify_m / metres_per_unit
+        polygons = [polygon.simplify(tolerance, preserve_topology=True) for polygon in polygons]
+        polygons = [polygon for polygon in polygons if not polygon.is_empty]
+    return polygons
+
+
+def save_mask_to_geojson(mask, transform, output_file, min_pixels=0, closing_iterations=0, simplify_m=0):
+    """
+    Сохраняет бинарную маску в формате GeoJSON.
+    :param mask: Бинарная маска (2D массив).
+    :param transform: Трансформация (геопривязка).
+    :param output_file: Имя выходного GeoJSON файла.
+    :param min_pixels: Порог sieve в пикселях (см. clean_mask).
+    :param closing_iterations: Итерации морфологического закрытия (см. clean_mask).
+    :param simplify_m: Допуск упрощения полигонов в метрах.
+    :return: Число сохранённых полигонов.
+    """
+    mask = clean_mask(mask, min_pixels, closing_iterations)
+    polygons = mask_to_polygons(mask, transform, simplify_m)
+    features = [geojson.Feature(geometry=mapping(polygon), properties={}) for polygon in polygons]
+
+    geojson_data = geojson.FeatureCollection(features)
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)  # Создаем папку, если она отсутствует
+    # Запись через временный файл: прерванный процесс не оставит обрезанный GeoJSON. Имя уникально,
+    # чтобы не мешать второму воркеру, взявшему то же задание после истечения аренды
+    tmp_file = f"{output_file}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_file, 'w') as f:
+        geojson.dump(geojson_data, f)
+    os.replace(tmp_file, output_file)
+
+    print(f"Маска успешно сохранена в {output_file}")
+    return len(features)
@@ -0,0 +1,255 @@
+"""
+Демон, который следит за папкой с исходными гранулами и проводит каждую новую гранулу
+через все этапы: ingest -> поиск дат -> загрузка бэндов -> индексы -> векторизация.
+
+Каждый этап работает в своём потоке и получает гранулы из ограниченной очереди: если этап
+не успевает, предыдущий блокируется на записи в очередь (backpressure), и в работе одновременно
+не больше queue_size гранул на этап. Все этапы идемпотентны (пропускают готовые артефакты),
+поэтому после перезапуска незавершённые гранулы просто проходят конвейер заново.
+"""
+import os
+import json
+import time
+import queue
+import threading
+from datetime import datetime
+from pathlib import Path
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # Нет inotify (Windows, macOS) - опрос папки по таймеру
+    INotify = None
+
+from index_cache import NDWI_THRESHOLD, DIFF_THRESHOLD
+
+STAGES = ["ingest", "dates", "bands", "index", "vectorize"]
+STATE_FILENAME = "watch_state.json"
+
+
+def find_granule_xmls(path_in):
+    """
+    MTD_MSIL1C.xml всех гранул в path_in (та же раскладка, что у ingest_granules: <папка>/<.SAFE>/MTD_MSIL1C.xml).
+    """
+    xml_paths = []
+    for el in sorted(os.listdir(path_in)):
+        folder = os.path.join(path_in, el)
+        if not os.path.isdir(folder):
+            continue
+        for safe in os.listdir(folder):
+            xml_path = os.path.join(folder, safe, "MTD_MSIL1C.xml")
+            if os.path.exists(xml_path):
+                xml_paths.append(xml_path)
+    return xml_paths
+
+
+def make_waiter(path_in, poll_seconds, stop):
+    """
+    Возвращает функцию, которая ждёт изменений в path_in (inotify) или просто poll_seconds.
+    """
+    if INotify is None:
+        return lambda: stop.wait(poll_seconds)
+
+    inotify = INotify()
+    watch_flags = flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE
+    watched = set()
+
+    def wait():
+        # Новые подпапки гранул тоже ставятся под наблюдение
+        for root, dirs, _ in os.walk(path_in):
+            if root not in watched:
+                inotify.add_watch(root, watch_flags)
+                watched.add(root)
+            if os.path.relpath(root, path_in).count(os.sep) >= 1:
+                dirs[:] = []
+        inotify.read(timeout=int(poll_seconds * 1000))
+
+    return wait
+
+
+def load_state(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, "r") as f:
+        return json.load(f)
+
+
+def write_json(file_path, data):
+    tmp_file = file_path + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_file, file_path)
+
+
+def make_stage_handlers(path_out, bands_dir, instance_id, start_date, end_date, search_mode="hierarchical",
+                        max_candidates=5, threshold=1.0, max_cloud_cover=None,
+                        ndwi_threshold=NDWI_THRESHOLD, diff_threshold=DIFF_THRESHOLD,
+                        vectorize_options=None, stats_db=None):
+    """
+    Обработчики этапов. Каждый принимает путь к MTD_MSIL1C.xml гранулы и возвращает False,
+    если гранулу дальше передавать не нужно (например, она отсеяна triage).
+    """
+    def granule_dirs(xml_path):
+        granule = Path(xml_path).parent.name
+        return os.path.join(path_out, granule), os.path.join(bands_dir, granule)
+
+    def ingest(xml_path):
+        from get_gridded_data import (INSTANCE_ID, make_config, ingest_complete, triage_granules,
+                                      download_gridded_data)
+
+        tiles_dir, _ = granule_dirs(xml_path)
+        if ingest_complete(tiles_dir):
+            return True
+        accepted, _ = triage_granules([xml_path], make_config(INSTANCE_ID), max_cloud_cover)
+        if not accepted:
+            return False
+        download_gridded_data(xml_path, path_out, check_catalog=False)
+        return True
+
+    def dates(xml_path):
+        from clear_dates import (DATES_FILENAME, make_config, search_params, read_dates, write_dates,
+                                 find_granule_dates, invalidate_bands)
+
+        tiles_dir, granule_bands_dir = granule_dirs(xml_path)
+        dates_file = os.path.join(granule_bands_dir, DATES_FILENAME)
+        search = search_params(start_date, end_date, search_mode, max_candidates, threshold)
+        if os.path.exists(dates_file):
+            found, previous = read_dates(dates_file)
+            if previous == search:
+                return bool(found)
+        found = find_granule_dates(tiles_dir, make_config(instance_id),
+                                   datetime.strptime(start_date, "%Y-%m-%d"),
+                                   datetime.strptime(end_date, "%Y-%m-%d"),
+                                   search_mode, max_candidates, threshold)
+        os.makedirs(granule_bands_dir, exist_ok=True)
+        invalidate_bands(found, granule_bands_dir)
+        write_dates(dates_file, found, search)
+        return bool(found)
+
+    def bands(xml_path):
+        from clear_dates import (DATES_FILENAME, make_config, read_dates, download_granule_bands,
+                                 bands_to_download)
+
+        _, granule_bands_dir = granule_dirs(xml_path)
+        found, _ = read_dates(os.path.join(granule_bands_dir, DATES_FILENAME))
+        download_granule_bands(bands_to_download(found, granule_bands_dir), granule_bands_dir,
+                               make_config(instance_id))
+        return True
+
+    def tile_pairs(xml_path):
+        from tile_stream import find_tiff_files_by_subfolder
+
+        tiles_dir, granule_bands_dir = granule_dirs(xml_path)
+        bands_dict = find_tiff_files_by_subfolder(granule_bands_dir, "bands.tiff")
+        response_dict = find_tiff_files_by_subfolder(tiles_dir, "response.tiff")
+        return [(bands_dict[name], response_dict[name]) for name in sorted(set(bands_dict) & set(response_dict))]
+
+    def index(xml_path):
+        from index_cache import load_or_compute_indices
+
+        for bands_path, response_path in tile_pairs(xml_path):
+            load_or_compute_indices(bands_path, response_path)
+        return True
+
+    def vectorize(xml_path):
+        from mask_stage import process_tile
+
+        for bands_path, response_path in tile_pairs(xml_path):
+            process_tile(bands_path, response_path, ndwi_threshold, diff_threshold, vectorize_options, stats_db)
+        return True
+
+    return {"ingest": ingest, "dates": dates, "bands": bands, "index": index, "vectorize": vectorize}
+
+
+def run_daemon(path_in, path_out, bands_dir, handlers, poll_seconds=30, queue_size=2, settle_seconds=60,
+               stop=None):
+    """
+    Следит за path_in и проводит новые гранулы через этапы STAGES.
+    :param handlers: Словарь {этап: функция(xml_path) -> bool} (make_stage_handlers).
+    :param queue_size: Ёмкость очереди перед каждым этапом.
+    :param settle_seconds: Гранула берётся в работу, только если её xml не менялся столько секунд.
+    :param stop: threading.Event для остановки (по умолчанию - до KeyboardInterrupt).
+    """
+    stop = stop or threading.Event()
+    started_at = time.time()
+    state_file = os.path.join(path_out, STATE_FILENAME)
+    os.makedirs(path_out, exist_ok=True)
+    state = load_state(state_file)
+    state_lock = threading.Lock()
+    in_flight = set()
+    queues = [queue.Queue(maxsize=max(queue_size, 1)) for _ in STAGES]
+
+    def record(xml_path, status, error=None):
+        with state_lock:
+            state[xml_path] = {"status": status, "error": error, "updated": time.time()}
+            write_json(state_file, state)
+            if status != "running":
+                in_flight.discard(xml_path)
+
+    def put(q, item):
+        # Блокирующая запись - это и есть backpressure; прерывается только остановкой демона
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker(i, stage):
+        while not stop.is_set():
+            try:
+                xml_path = queues[i].get(timeout=0.5)
+            except queue.Empty:
+                continue
+            started = time.perf_counter()
+            try:
+                passed = handlers[stage](xml_path)
+            except Exception as e:
+                print(f"[{stage}] Ошибка для {xml_path}: {e}")
+                record(xml_path, f"failed:{stage}", str(e))
+                continue
+            print(f"[{stage}] {Path(xml_path).parent.name}: {time.perf_counter() - started:.1f} с")
+            if not passed:
+                record(xml_path, f"skipped:{stage}")
+            elif i + 1 == len(STAGES):
+                record(xml_path, "done")
+            else:
+                put(queues[i + 1], xml_path)
+
+    def should_start(xml_path):
+        with state_lock:
+            if xml_path in in_flight:
+                return False
+            entry = state.get(xml_path)
+        if entry is None:
+            return True
+        # Готовые и отсеянные triage гранулы не повторяются, остальные - после перезапуска демона
+        if entry["status"] in ("done", "skipped:ingest"):
+            return False
+        return entry["updated"] < started_at
+
+    threads = [threading.Thread(target=worker, args=(i, stage), daemon=True) for i, stage in enumerate(STAGES)]
+    for thread in threads:
+        thread.start()
+
+    wait = make_waiter(path_in, poll_seconds, stop)
+    print(f"Наблюдение за {path_in} ({'inotify' if INotify else f'опрос каждые {poll_seconds} с'})")
+    try:
+        while not stop.is_set():
+            now = time.time()
+            for xml_path in find_granule_xmls(path_in):
+                if not should_start(xml_path) or now - os.path.getmtime(xml_path) < settle_seconds:
+                    continue
+                with state_lock:
+                    in_flight.add(xml_path)
+                record(xml_path, "running")
+                if not put(queues[0], xml_path):
+                    break
+            wait()
+    except KeyboardInterrupt:
+        print("Остановка демона")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+